@@ -124,8 +124,16 @@ class FoodDataset(utils.Dataset):
         # annotations. Skip unannotated images.
         annotations = [a for a in annotations if a['regions']]
 
+        # load_mask() needs the image size to convert polygons to masks.
+        # Unfortunately, VIA doesn't include it in JSON, so read it from the
+        # image headers. The sizes are saved next to the annotations and only
+        # read again for new or modified images.
+        image_paths = [os.path.join(dataset_dir, a['filename']) for a in annotations]
+        image_sizes = utils.read_image_sizes(
+            image_paths, index_path=os.path.join(dataset_dir, "via_image_sizes.json"))
+
         # Add images
-        for a in annotations:
+        for a, image_path, (height, width) in zip(annotations, image_paths, image_sizes):
             # Get the x, y coordinaets of points of the polygons that make up
             # the outline of each object instance. These are stores in the
             # shape_attributes (see json format above)
@@ -133,17 +141,10 @@ class FoodDataset(utils.Dataset):
             polygons = [r['shape_attributes'] for r in a['regions'].values()]
             objects = [s['region_attributes'] for s in a['regions'].values()]
             class_ids = [int(n['food']) for n in objects]
-			# load_mask() needs the image size to convert polygons to masks.
-            # Unfortunately, VIA doesn't include it in JSON, so we must read
-            # the image. This is only managable since the dataset is tiny.
             # print("multi_numbers=", multi_numbers)
             # num_ids = [n for n in multi_numbers['number'].values()]
             # for n in multi_numbers:
             
-            image_path = os.path.join(dataset_dir, a['filename'])
-            image = skimage.io.imread(image_path)
-            height, width = image.shape[:2]
-
             self.add_image(
                 "food",
                 image_id=a['filename'],  # use file name as a unique image id
@@ -181,6 +182,18 @@ class FoodDataset(utils.Dataset):
         class_ids = np.array(class_ids, dtype=np.int32)
         return mask, class_ids#[mask.shape[-1]] #np.ones([mask.shape[-1]], dtype=np.int32)#class_ids.astype(np.int32)
 
+    def load_polygons(self, image_id):
+        """Return the VIA polygons of an image as (y, x) vertex arrays, so
+        that load_image_gt() can rasterize them straight into mini masks.
+        """
+        info = self.image_info[image_id]
+        if info["source"] != "food":
+            return super(self.__class__, self).load_polygons(image_id)
+        polygons = [np.stack([p['all_points_y'], p['all_points_x']], axis=1)
+                    for p in info["polygons"]]
+        class_ids = np.array(info['class_ids'], dtype=np.int32)
+        return polygons, class_ids
+
     def image_reference(self, image_id):
         """Return the path of the image."""
         info = self.image_info[image_id]
@@ -229,7 +242,8 @@ def train(model):
 def color_splash(image, mask):
     """Apply color splash effect.
     image: RGB image [height, width, 3]
-    mask: instance segmentation mask [height, width, instance count]
+    mask: instance segmentation mask [height, width, instance count] or a
+        utils.CroppedMasks object
 
     Returns result image.
     """
@@ -239,7 +253,10 @@ def color_splash(image, mask):
     # Copy color pixels from the original color image where mask is set
     if mask.shape[-1] > 0:
         # We're treating all instances as one, so collapse the mask into one layer
-        mask = (np.sum(mask, -1, keep_dims=True) >= 1)
+        if isinstance(mask, utils.CroppedMasks):
+            mask = mask.union()[..., np.newaxis]
+        else:
+            mask = (np.sum(mask, -1, keep_dims=True) >= 1)
         splash = np.where(mask, image, gray).astype(np.uint8)
     else:
         splash = gray.astype(np.uint8)
@@ -0,0 +1,293 @@
+"""
+Mask R-CNN
+On-disk caches of detection results and preprocessed training samples.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import pickle
+import hashlib
+import threading
+import numpy as np
+
+from mrcnn import utils
+
+
+# Config attributes that change the results of MaskRCNN.detect().
+# They're part of the cache key, so changing any of them invalidates
+# previously cached results.
+CONFIG_KEYS = [
+    "BACKBONE", "BACKBONE_STRIDES", "NUM_CLASSES",
+    "TOP_DOWN_PYRAMID_SIZE", "FPN_CLASSIF_FC_LAYERS_SIZE",
+    "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS", "RPN_ANCHOR_STRIDE",
+    "RPN_NMS_THRESHOLD", "POST_NMS_ROIS_INFERENCE", "RPN_BBOX_STD_DEV",
+    "IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_MIN_SCALE",
+    "MEAN_PIXEL", "POOL_SIZE", "MASK_POOL_SIZE", "MASK_SHAPE",
+    "BBOX_STD_DEV", "DETECTION_MAX_INSTANCES", "DETECTION_MIN_CONFIDENCE",
+    "DETECTION_NMS_THRESHOLD", "DETECTION_MASK_FORMAT",
+    "USE_FUSED_PREPROCESSING",
+]
+
+
+# Config attributes that change the preprocessed training samples stored
+# in a SampleCache.
+SAMPLE_CONFIG_KEYS = [
+    "BACKBONE", "BACKBONE_STRIDES", "COMPUTE_BACKBONE_SHAPE",
+    "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS", "RPN_ANCHOR_STRIDE",
+    "IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_MIN_SCALE",
+    "USE_MINI_MASK", "MINI_MASK_SHAPE", "MAX_GT_INSTANCES", "NUM_CLASSES",
+]
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """Returns the SHA1 hex digest of the content of a file."""
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def config_fingerprint(config, keys=CONFIG_KEYS):
+    """Returns a string that identifies the values of the given config
+    attributes. Callables (e.g. a custom BACKBONE) are identified by name.
+    """
+    parts = []
+    for key in keys:
+        value = getattr(config, key, None)
+        if callable(value):
+            value = getattr(value, "__qualname__", repr(value))
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        parts.append("{}={!r}".format(key, value))
+    return ";".join(parts)
+
+
+def stable_repr(value):
+    """Returns a repr() of plain values (dicts, lists, NumPy arrays, ...)
+    that doesn't depend on the dict order or NumPy print options.
+    """
+    if isinstance(value, dict):
+        items = sorted((repr(k), stable_repr(v)) for k, v in value.items())
+        return "{" + ", ".join("{}: {}".format(k, v) for k, v in items) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(stable_repr(v) for v in value) + "]"
+    if isinstance(value, np.ndarray):
+        return "array({}, {})".format(value.tolist(), value.dtype.str)
+    return repr(value)
+
+
+def dataset_fingerprint(dataset):
+    """Returns a string that identifies the classes and image entries of
+    a utils.Dataset. Images are identified by all the values stored with
+    add_image(): source, ID and path, and the annotations the dataset keeps
+    there, such as the polygons and class IDs of food.py. The image files
+    and annotations loaded from elsewhere in load_mask() aren't part of
+    it, so clear the cache when they change.
+    """
+    sha = hashlib.sha1(type(dataset).__qualname__.encode("utf-8"))
+    for info in dataset.class_info:
+        sha.update(stable_repr(info).encode("utf-8"))
+    for info in dataset.image_info:
+        sha.update(stable_repr(info).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class DetectionCache(object):
+    """Content-addressed cache of detection results on disk.
+
+    Results are keyed by the SHA1 of the image pixels combined with a
+    fingerprint of the model (weights and config, see MaskRCNN). Each
+    result is stored in its own file, so several processes can share
+    the same cache directory. When the total size exceeds max_size, the
+    least recently used results are deleted.
+
+    Dense masks are stored cropped to their boxes (see utils.CroppedMasks)
+    to keep the files small.
+    """
+
+    def __init__(self, cache_dir, fingerprint, max_size=1 << 30):
+        """
+        cache_dir: Directory to store the results in. Created if needed.
+        fingerprint: String that identifies the model producing the results.
+        max_size: Max total size of the cache in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint.encode("utf-8")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(p) for p, _ in self._entries())
+
+    def key(self, image):
+        """Returns the cache key of the results of the given image."""
+        image = np.ascontiguousarray(image)
+        sha = hashlib.sha1(self.fingerprint)
+        sha.update("{}{}".format(image.shape, image.dtype.str).encode("utf-8"))
+        sha.update(image.data)
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".pkl")
+
+    def _entries(self):
+        """Yields (path, mtime) of all the results in the cache."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".pkl"):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.path.getmtime(path)
+                    except OSError:
+                        pass
+
+    def get(self, key):
+        """Returns the cached result dict of the key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if result.pop("dense", False):
+            result["masks"] = result["masks"].dense()
+        return result
+
+    def put(self, key, result):
+        """Stores a result dict as returned by MaskRCNN.detect()."""
+        result = dict(result)
+        if isinstance(result["masks"], np.ndarray):
+            result["masks"] = utils.CroppedMasks.from_dense(result["masks"])
+            result["dense"] = True
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see partial files.
+        # Its name is unique to the process and thread, as several of them
+        # can write the same result at once.
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(),
+                                         threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.size += os.path.getsize(path) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Deletes the least recently used results until the cache is
+        below 90% of max_size.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        size = sum(os.path.getsize(p) for p, _ in entries)
+        for path, _ in entries:
+            if size <= 0.9 * self.max_size:
+                break
+            try:
+                file_size = os.path.getsize(path)
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+        self.size = size
+
+    def clear(self):
+        """Deletes all the cached results."""
+        for path, _ in list(self._entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
+
+
+class SampleCache(object):
+    """Memory-mapped cache of fixed-size samples on disk.
+
+    Each field is stored in its own .npy file with one row per sample, and
+    a "filled" array records which samples are stored. The files are opened
+    with np.memmap, so reading a sample only touches its own rows, and
+    several processes can read and write different samples of the same
+    cache. The files are created at full size, which most file systems
+    store sparsely until the samples are written.
+
+    The cache lives in a sub-directory named after the SHA1 of key, so
+    samples made with different settings don't mix.
+    """
+
+    def __init__(self, cache_dir, key, count, fields):
+        """
+        cache_dir: Directory to store the caches in. Created if needed.
+        key: String that identifies the settings that produce the samples.
+        count: Number of samples.
+        fields: List of (name, shape, dtype) of the fields of one sample.
+        """
+        self.path = os.path.join(
+            cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+        self.count = count
+        self.fields = [(name, tuple(int(d) for d in shape), np.dtype(dtype))
+                       for name, shape, dtype in fields]
+        os.makedirs(self.path, exist_ok=True)
+        for name, shape, dtype in self.fields + [("filled", (), np.dtype(bool))]:
+            self._create(name, (count,) + shape, dtype)
+        self.arrays = None
+
+    def __getstate__(self):
+        # Memory maps would be pickled as copies. Reopen them instead.
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def _create(self, name, shape, dtype):
+        """Creates the file of a field unless it exists with the same shape."""
+        path = os.path.join(self.path, name + ".npy")
+        try:
+            array = np.load(path, mmap_mode="r")
+            if array.shape == shape and array.dtype == dtype:
+                return
+        except (OSError, ValueError):
+            pass
+        # Write to a temporary file first so readers never see partial files
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape).flush()
+        os.replace(tmp_path, path)
+
+    def _open(self):
+        if self.arrays is None:
+            self.arrays = {
+                name: np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r+")
+                for name in [f[0] for f in self.fields] + ["filled"]}
+        return self.arrays
+
+    def get(self, index):
+        """Returns a dict of the fields of a sample, or None if the sample
+        isn't stored. The arrays are copies.
+        """
+        arrays = self._open()
+        if not arrays["filled"][index]:
+            return None
+        return {name: np.array(arrays[name][index]) for name, _, _ in self.fields}
+
+    def put(self, index, **values):
+        """Stores the fields of a sample. All fields are required."""
+        arrays = self._open()
+        for name, _, _ in self.fields:
+            arrays[name][index] = values[name]
+        # Mark the sample as stored after all its fields are written
+        arrays["filled"][index] = True
+
+    def clear(self):
+        """Marks all the samples as not stored."""
+        self._open()["filled"][:] = False
@@ -116,6 +116,12 @@ class Config(object):
     #         up before padding. IMAGE_MAX_DIM is ignored in this mode.
     #         The multiple of 64 is needed to ensure smooth scaling of feature
     #         maps up and down the 6 levels of the FPN pyramid (2**6=64).
+    # rect:   Scales like the square mode, then pads width and height with
+    #         zeros to make them multiples of 64 rather than IMAGE_MAX_DIM.
+    #         Avoids running the backbone on padding with non-square
+    #         images. MaskRCNN.detect_many() batches same-shape images.
+    #         Can be used in inference only. Training batches need the
+    #         fixed IMAGE_SHAPE, which stays square.
     # crop:   Picks random crops from the image. First, scales the image based
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
@@ -132,6 +138,51 @@ class Config(object):
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
+    # Resize, pad and normalize the images of a batch in one pass per image
+    # in MaskRCNN.mold_inputs(), writing straight into the batch array (see
+    # utils.mold_image_into()). Saves several full size copies per image, but
+    # the resampling isn't the one resize_image() uses in training: a
+    # triangle filter instead of skimage's Gaussian anti-aliasing when
+    # downscaling, and edge pixels are clamped instead of blended with zero
+    # padding. That changes the detections slightly, so it's off by default.
+    USE_FUSED_PREPROCESSING = False
+
+    # Number of threads used to resize and normalize the images of a batch
+    # with USE_FUSED_PREPROCESSING. Only part of the work overlaps, as the
+    # index gathers hold the GIL. Set to 1 to process them one at a time.
+    PREPROCESS_WORKERS = 4
+
+    # Number of processes that load images and build the training batches
+    # in MaskRCNN.train(). 0 loads the batches in the training process, and
+    # None uses one process per CPU core. The training and validation loaders
+    # each start this many processes, at most one per image. DATA_LOADER_PREFETCH
+    # is the number of finished batches kept in shared memory by each loader.
+    # Each one takes about BATCH_SIZE * IMAGE_MAX_DIM**2 * 12 bytes for the
+    # images, plus BATCH_SIZE * MAX_GT_INSTANCES bytes per mask pixel. With
+    # USE_MINI_MASK that's small, but without it the masks are full size:
+    # about 100 MB per image at 1024x1024, or 1.6 GB for 8 batches of 2
+    # images. Lower DATA_LOADER_PREFETCH when training without mini masks.
+    # See DataLoader.
+    DATA_LOADER_WORKERS = 0
+    DATA_LOADER_PREFETCH = 8
+
+    # Feed MaskRCNN.train() with a DataSequence instead of a generator. Each
+    # batch then only depends on its epoch and index, so Keras loads them
+    # with DATA_LOADER_WORKERS processes of its own and a training resumed
+    # from the last checkpoint continues at the same position in the data.
+    USE_DATA_SEQUENCE = False
+
+    # Directory of the on-disk cache of preprocessed training samples. If
+    # set, images that aren't augmented (all validation images, and training
+    # images when augmentation is None or skipped for their source) are
+    # resized and matched to anchors once, then memory-mapped from the cache.
+    # Needs about IMAGE_MAX_DIM**2 * 3 bytes per image for the image, plus
+    # MAX_GT_INSTANCES bytes per mask pixel: MAX_GT_INSTANCES * IMAGE_MAX_DIM**2
+    # bytes without mini masks (about 100 MB per image with the defaults), or
+    # MAX_GT_INSTANCES times the area of MINI_MASK_SHAPE with them. Plus 3
+    # bytes per anchor. Not available with the "crop" resize mode.
+    SAMPLE_CACHE_DIR = None
+
     # Number of ROIs per image to feed to classifier/mask heads
     # The Mask RCNN paper uses 512 but often the RPN doesn't generate
     # enough positive proposals to fill this and keep a positive:negative
@@ -167,6 +218,36 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Generate the anchors inside the inference graph instead of feeding
+    # them to the model with every batch. The anchors then match the actual
+    # shape of the input images and the model only takes two inputs
+    # (images and image metas), which matters if you export it.
+    GRAPH_ANCHORS = False
+
+    # Convert the detection boxes to original image coordinates and pick the
+    # mask of the predicted class inside the inference graph. Much less data
+    # is copied back from the GPU, but the format of the detections and
+    # masks outputs of the inference model changes. See DetectionUnmoldLayer.
+    GRAPH_UNMOLD = False
+
+    # Format of the instance masks returned by MaskRCNN.detect()
+    # dense:   [height, width, instances] bool array. The masks are full size
+    #          so memory grows with image size times instance count.
+    # cropped: utils.CroppedMasks object. Each mask is cropped to its
+    #          bounding box. Use its dense() and instance() methods to get
+    #          full size masks.
+    # rle:     List of COCO run-length encoded masks, one dict per instance.
+    #          See utils.encode_rle(). Compact and JSON serializable.
+    DETECTION_MASK_FORMAT = "dense"
+
+    # Directory of the on-disk cache of detection results. If set,
+    # MaskRCNN.detect_many() and detect_stream() reuse the results of images
+    # that were already processed with the same weights and config.
+    # DETECTION_CACHE_SIZE is the max size of the cache in bytes. The least
+    # recently used results are deleted when it's exceeded.
+    DETECTION_CACHE_DIR = None
+    DETECTION_CACHE_SIZE = 1024 ** 3
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
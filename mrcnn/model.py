@@ -13,10 +13,13 @@ import datetime
 import re
 import math
 import logging
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import concurrent.futures
+import queue
+import threading
+import traceback
 import multiprocessing
 import numpy as np
-import skimage.transform
 import tensorflow as tf
 import keras
 import keras.backend as K
@@ -25,6 +28,8 @@ import keras.engine as KE
 import keras.models as KM
 
 from mrcnn import utils
+from mrcnn.cache import DetectionCache, SampleCache, SAMPLE_CONFIG_KEYS, \
+    config_fingerprint, dataset_fingerprint, hash_file
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -830,6 +835,72 @@ class DetectionLayer(KE.Layer):
         return (None, self.config.DETECTION_MAX_INSTANCES, 6)
 
 
+class DetectionUnmoldLayer(KE.Layer):
+    """Does the per-detection part of MaskRCNN.unmold_detections() in the
+    graph. Converts the detection boxes to pixel coordinates in the original
+    image and picks the mask of the predicted class of each detection, so
+    only [batch, num_detections, height, width] masks are copied back from
+    the GPU instead of the masks of all classes.
+
+    Inputs:
+    detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)]
+        in normalized coordinates. The output of DetectionLayer.
+    mrcnn_mask: [batch, num_detections, height, width, num_classes]
+    image_meta: [batch, (meta data)] Image details. See compose_image_meta()
+
+    Returns:
+    detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)]
+        where the boxes are rounded pixel coordinates in the original image.
+    masks: [batch, num_detections, height, width] float masks of the
+        predicted classes.
+    """
+
+    def __init__(self, config=None, **kwargs):
+        super(DetectionUnmoldLayer, self).__init__(**kwargs)
+        self.config = config
+
+    def call(self, inputs):
+        detections = inputs[0]
+        mrcnn_mask = inputs[1]
+        image_meta = inputs[2]
+
+        # Window of each image in normalized coordinates. As in
+        # DetectionLayer, all images of the batch have the same shape.
+        m = parse_image_meta_graph(image_meta)
+        window = norm_boxes_graph(m['window'], m['image_shape'][0][:2])
+        # [batch, 1, (y1, x1, y1, x1)] and [batch, 1, (h, w, h, w)]
+        wy1, wx1, wy2, wx2 = tf.split(window[:, None], 4, axis=2)
+        shift = tf.concat([wy1, wx1, wy1, wx1], axis=2)
+        wh, ww = wy2 - wy1, wx2 - wx1
+        scale = tf.concat([wh, ww, wh, ww], axis=2)
+        # Convert boxes to normalized coordinates on the window
+        boxes = tf.divide(detections[..., :4] - shift, scale)
+        # Convert boxes to pixel coordinates on the original image.
+        # Same as denorm_boxes_graph() but with one shape per image.
+        h, w = tf.split(m['original_image_shape'][:, None, :2], 2, axis=2)
+        scale = tf.concat([h, w, h, w], axis=2) - tf.constant(1.0)
+        shift = tf.constant([0., 0., 1., 1.])
+        boxes = tf.round(tf.multiply(boxes, scale) + shift)
+        detections = tf.concat([boxes, detections[..., 4:]], axis=2)
+
+        # Pick the mask of the predicted class of each detection
+        class_ids = tf.cast(detections[..., 4], tf.int32)
+        class_mask = tf.one_hot(class_ids, self.config.NUM_CLASSES)
+        masks = tf.reduce_sum(mrcnn_mask * class_mask[:, :, None, None, :],
+                              axis=-1)
+        return [detections, masks]
+
+    def compute_output_shape(self, input_shape):
+        return [
+            (None, self.config.DETECTION_MAX_INSTANCES, 6),  # detections
+            (None, self.config.DETECTION_MAX_INSTANCES,
+             self.config.MASK_SHAPE[0], self.config.MASK_SHAPE[1])  # masks
+        ]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None, None]
+
+
 ############################################################
 #  Region Proposal Network (RPN)
 ############################################################
@@ -1195,7 +1266,7 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 ############################################################
 
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
-                  use_mini_mask=False):
+                  use_mini_mask=False, random_state=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: (deprecated. Use augmentation instead). If true, apply random
@@ -1208,6 +1279,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    random_state: Optional. A np.random.RandomState that decides the random
+        crops, flips and augmentations, so they don't depend on the global
+        random states. The augmentation is seeded from it.
 
     Returns:
     image: [height, width, 3]
@@ -1220,23 +1294,47 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     """
     # Load image and mask
     image = dataset.load_image(image_id)
-    mask, class_ids = dataset.load_mask(image_id)
+    # Instances stored as polygons go straight to mini masks, and are
+    # augmented by moving their vertices. See Dataset.load_polygons().
+    polygons = None
+    if use_mini_mask:
+        polygons = dataset.load_polygons(image_id)
+    if polygons is not None:
+        polygons, class_ids = polygons
+        class_ids = np.asarray(class_ids, dtype=np.int32)
+    else:
+        mask, class_ids = dataset.load_mask(image_id)
     original_shape = image.shape
     image, window, scale, padding, crop = utils.resize_image(
         image,
         min_dim=config.IMAGE_MIN_DIM,
         min_scale=config.IMAGE_MIN_SCALE,
         max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+        mode=config.IMAGE_RESIZE_MODE,
+        random_state=random_state)
+    if polygons is not None:
+        polygons = utils.resize_polygons(polygons, scale, padding, crop)
+        # Area the polygons are clipped to. The image, without padding.
+        polygon_window = window
+    else:
+        mask = utils.resize_mask(mask, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
     if augment:
         logging.warning("'augment' is deprecated. Use 'augmentation' instead.")
-        if random.randint(0, 1):
+        if random_state is None:
+            flip = random.randint(0, 1)
+        else:
+            flip = random_state.randint(0, 2)
+        if flip:
             image = np.fliplr(image)
-            mask = np.fliplr(mask)
+            if polygons is not None:
+                polygons = [p * [1, -1] + [0, image.shape[1] - 1] for p in polygons]
+                polygon_window = (window[0], image.shape[1] - window[3],
+                                  window[2], image.shape[1] - window[1])
+            else:
+                mask = np.fliplr(mask)
 
     # Augmentation
     # This requires the imgaug lib (https://github.com/aleju/imgaug)
@@ -1256,28 +1354,80 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
         # Store shapes before augmentation to compare
         image_shape = image.shape
-        mask_shape = mask.shape
         # Make augmenters deterministic to apply similarly to images and masks
-        det = augmentation.to_deterministic()
+        if random_state is None:
+            det = augmentation.to_deterministic()
+        elif hasattr(augmentation, "seed_"):
+            # imgaug 0.4+. Seed a copy, so imgaug's global random state
+            # isn't used either.
+            det = augmentation.deepcopy()
+            det.seed_(random_state.randint(2 ** 31))
+            det = det.to_deterministic()
+        else:
+            det = augmentation.to_deterministic()
+            det.reseed(random_state.randint(2 ** 31), deterministic_too=True)
         image = det.augment_image(image)
-        # Change mask to np.uint8 because imgaug doesn't support np.bool
-        mask = det.augment_image(mask.astype(np.uint8),
-                                 hooks=imgaug.HooksImages(activator=hook))
+        if polygons is not None:
+            # Move the vertices instead of warping full size masks. Clip the
+            # polygons to the image first, as rasterizing them on the image
+            # would. The cost doesn't depend on the image size or the number
+            # of instances.
+            polygons = utils.clip_polygons(polygons, polygon_window)
+            polygon_window = None
+            points = np.concatenate([np.zeros([0, 2])] + polygons)
+            # imgaug 0.3+ places pixel centers at +0.5, older versions at
+            # integer coordinates like the polygons.
+            if LooseVersion(imgaug.__version__) >= LooseVersion("0.3.0"):
+                offset = 0.5
+            else:
+                offset = 0.0
+            keypoints = imgaug.KeypointsOnImage.from_xy_array(
+                points[:, ::-1] + offset, shape=image_shape)
+            keypoints = det.augment_keypoints(
+                [keypoints], hooks=imgaug.HooksKeypoints(activator=hook))[0]
+            points = keypoints.to_xy_array()[:, ::-1] - offset
+            polygons = np.split(points.reshape([-1, 2]),
+                                np.cumsum([len(p) for p in polygons])[:-1])
+        else:
+            # Check with a grid of keypoints if the augmenters that apply to
+            # masks moved anything in this sample. If only photometric
+            # augmenters were active, the masks don't change and warping
+            # them can be skipped.
+            ys, xs = np.meshgrid(np.linspace(0, image_shape[0] - 1, 8),
+                                 np.linspace(0, image_shape[1] - 1, 8), indexing="ij")
+            grid = np.stack([xs.ravel(), ys.ravel()], axis=1)
+            probes = imgaug.KeypointsOnImage.from_xy_array(grid, shape=image_shape)
+            probes = det.augment_keypoints(
+                [probes], hooks=imgaug.HooksKeypoints(activator=hook))[0]
+            geometric = tuple(probes.shape) != tuple(image_shape) or \
+                not np.allclose(probes.to_xy_array(), grid, rtol=0, atol=1e-3)
+            if geometric:
+                mask_shape = mask.shape
+                # Change mask to np.uint8 because imgaug doesn't support np.bool
+                mask = det.augment_image(mask.astype(np.uint8),
+                                         hooks=imgaug.HooksImages(activator=hook))
+                assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
+                # Change mask back to bool
+                mask = mask.astype(np.bool)
         # Verify that shapes didn't change
         assert image.shape == image_shape, "Augmentation shouldn't change image size"
-        assert mask.shape == mask_shape, "Augmentation shouldn't change mask size"
-        # Change mask back to bool
-        mask = mask.astype(np.bool)
-
-    # Note that some boxes might be all zeros if the corresponding mask got cropped out.
-    # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
-    class_ids = class_ids[_idx]
-    # Bounding boxes. Note that some boxes might be all zeros
-    # if the corresponding mask got cropped out.
-    # bbox: [num_instances, (y1, x1, y2, x2)]
-    bbox = utils.extract_bboxes(mask)
+
+    if polygons is not None:
+        # Boxes come from the vertices and the polygons are rasterized at
+        # mini mask size. Polygons that got cropped out are dropped.
+        bbox, mask, keep = utils.minimize_polygons(
+            polygons, image.shape[:2], config.MINI_MASK_SHAPE, polygon_window)
+        class_ids = class_ids[keep]
+    else:
+        # Note that some boxes might be all zeros if the corresponding mask got cropped out.
+        # and here is to filter them out
+        _idx = np.sum(mask, axis=(0, 1)) > 0
+        mask = mask[:, :, _idx]
+        class_ids = class_ids[_idx]
+        # Bounding boxes. Note that some boxes might be all zeros
+        # if the corresponding mask got cropped out.
+        # bbox: [num_instances, (y1, x1, y2, x2)]
+        bbox = utils.extract_bboxes(mask)
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1287,7 +1437,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
-    if use_mini_mask:
+    if use_mini_mask and polygons is None:
         mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
@@ -1418,80 +1568,116 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
                        config.NUM_CLASSES, 4), dtype=np.float32)
     pos_ids = np.where(roi_gt_class_ids > 0)[0]
     bboxes[pos_ids, roi_gt_class_ids[pos_ids]] = utils.box_refinement(
-        rois[pos_ids], roi_gt_boxes[pos_ids, :4])
-    # Normalize bbox refinements
-    bboxes /= config.BBOX_STD_DEV
+        rois[pos_ids], roi_gt_boxes[pos_ids, :4], config.BBOX_STD_DEV)
 
     # Generate class-specific target masks
     masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
                      dtype=np.float32)
+    # GT masks expanded from mini masks to the size of their boxes
+    box_masks = {}
     for i in pos_ids:
         class_id = roi_gt_class_ids[i]
         assert class_id > 0, "class id must be greater than 0"
         gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
+        y1, x1, y2, x2 = rois[i].astype(np.int32)
 
         if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
+            # Resize mini mask to size of GT box. Once per GT box.
             gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(skimage.transform.resize(
-                    class_mask, (gt_h, gt_w), order=1, mode="constant")).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
-
-        # Pick part of the mask and resize it
-        y1, x1, y2, x2 = rois[i].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = skimage.transform.resize(m, config.MASK_SHAPE, order=1, mode="constant")
-        masks[i, :, :, class_id] = mask
+            if gt_id not in box_masks:
+                box_masks[gt_id] = utils.resize_mask_to_box(
+                    gt_masks[:, :, gt_id], gt_y2 - gt_y1, gt_x2 - gt_x1) > 0.5
+            # Copy the part of it inside the ROI. The rest of the ROI is
+            # outside of the GT box, and so outside of the mask.
+            m = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+            oy1, ox1 = max(y1, gt_y1), max(x1, gt_x1)
+            oy2, ox2 = min(y2, gt_y2), min(x2, gt_x2)
+            if oy2 > oy1 and ox2 > ox1:
+                m[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = \
+                    box_masks[gt_id][oy1 - gt_y1:oy2 - gt_y1, ox1 - gt_x1:ox2 - gt_x1]
+        else:
+            # Pick part of the mask
+            m = gt_masks[y1:y2, x1:x2, gt_id]
+
+        # Resize it
+        masks[i, :, :, class_id] = utils.resize_mask_to_box(
+            m, config.MASK_SHAPE[0], config.MASK_SHAPE[1])
 
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional utils.AnchorGridIndex of the anchors. If given,
+        IoUs are only computed for the anchors near the GT boxes. The
+        results are the same.
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    rpn_match, anchor_iou_argmax = match_rpn_anchors(
+        anchors, gt_class_ids, gt_boxes, anchor_index=anchor_index)
+    return sample_rpn_targets(anchors, rpn_match, anchor_iou_argmax, gt_boxes,
+                              config)
+
+
+def match_rpn_anchors(anchors, gt_class_ids, gt_boxes, anchor_index=None):
+    """Matches anchors to GT boxes. This is the deterministic part of
+    build_rpn_targets(), before positive and negative anchors are sampled.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [num_gt_boxes] Integer class IDs.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional utils.AnchorGridIndex of the anchors.
+
+    Returns:
+    rpn_match: [N] (int32) 1 = positive anchor, -1 = negative anchor,
+               0 = neutral. All matches, not sampled.
+    anchor_iou_argmax: [N] Index in gt_boxes of the closest non-crowd GT
+                       box of each anchor.
+    """
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
     crowd_ix = np.where(gt_class_ids < 0)[0]
+    non_crowd_ix = np.where(gt_class_ids > 0)[0]
     if crowd_ix.shape[0] > 0:
-        # Filter out crowds from ground truth class IDs and boxes
-        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        # Filter out crowds from ground truth boxes
         crowd_boxes = gt_boxes[crowd_ix]
-        gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        # Max overlap of each anchor with the crowd boxes
+        if anchor_index is not None:
+            crowd_iou_max = anchor_index.compute_overlaps_max(crowd_boxes)[0]
+        else:
+            crowd_iou_max = utils.compute_overlaps_max(anchors, crowd_boxes)[0]
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Best matches between anchors and GT boxes. The full overlaps matrix
+    # [num_anchors, num_gt_boxes] isn't needed.
+    if anchor_index is not None:
+        # IoUs under 0.3 only need to be known to be under 0.3
+        anchor_iou_max, anchor_iou_argmax, _, gt_iou_argmax = \
+            anchor_index.compute_overlaps_max(gt_boxes, min_iou=0.3)
+    else:
+        anchor_iou_max, anchor_iou_argmax, _, gt_iou_argmax = \
+            utils.compute_overlaps_max(anchors, gt_boxes)
+    if crowd_ix.shape[0] > 0:
+        # Index in the boxes that include crowds
+        anchor_iou_argmax = non_crowd_ix[anchor_iou_argmax]
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1503,23 +1689,42 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
+    return rpn_match, anchor_iou_argmax
+
+
+def sample_rpn_targets(anchors, rpn_match, anchor_iou_argmax, gt_boxes, config,
+                       random_state=None):
+    """Samples positive and negative anchors from the matches returned by
+    match_rpn_anchors() and computes the deltas of the positive ones.
+
+    rpn_match: [N] Matches. Not modified.
+    anchor_iou_argmax: [N] Index in gt_boxes of the closest GT box.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    random_state: Optional. A np.random.RandomState to sample with. Uses the
+        global NumPy random state if not provided.
+
+    Returns rpn_match and rpn_bbox as build_rpn_targets() does.
+    """
+    if random_state is None:
+        random_state = np.random
+    rpn_match = np.array(rpn_match, dtype=np.int32)
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
     # Subsample to balance positive and negative anchors
     # Don't let positives be more than half the anchors
     ids = np.where(rpn_match == 1)[0]
     extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
     if extra > 0:
         # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
     # Same for negative proposals
     ids = np.where(rpn_match == -1)[0]
@@ -1527,40 +1732,15 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
                         np.sum(rpn_match == 1))
     if extra > 0:
         # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(ids, extra, replace=False)
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
+    # to match the corresponding GT boxes. The closest GT box of an anchor
+    # might have IoU < 0.7.
     ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    rpn_bbox[:len(ids)] = utils.box_refinement(
+        anchors[ids], gt_boxes[anchor_iou_argmax[ids]], config.RPN_BBOX_STD_DEV)
 
     return rpn_match, rpn_bbox
 
@@ -1639,9 +1819,111 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+def create_sample_cache(dataset, config, cache_dir):
+    """Returns a SampleCache for the un-augmented training samples of a
+    dataset, as loaded by load_rpn_sample(). The cache is specific to the
+    image entries of the dataset and the config values that change the
+    samples, so different datasets and configs can share cache_dir.
+
+    The cache stores resized images, image metas, GT class IDs, boxes and
+    masks, and the anchor matches of build_rpn_targets() before positive and
+    negative anchors are sampled, so the sampling stays random.
+    """
+    assert config.IMAGE_RESIZE_MODE != "crop", \
+        "Random crops can't be cached."
+    anchor_count = utils.generate_pyramid_anchors(
+        config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+        compute_backbone_shapes(config, config.IMAGE_SHAPE),
+        config.BACKBONE_STRIDES, config.RPN_ANCHOR_STRIDE).shape[0]
+    if config.USE_MINI_MASK:
+        mask_shape = tuple(config.MINI_MASK_SHAPE)
+    else:
+        mask_shape = tuple(config.IMAGE_SHAPE[:2])
+    max_gt = config.MAX_GT_INSTANCES
+    fields = [
+        ("image", tuple(config.IMAGE_SHAPE), np.uint8),
+        ("image_meta", (config.IMAGE_META_SIZE,), np.float64),
+        ("instance_count", (), np.int32),
+        ("class_ids", (max_gt,), np.int32),
+        ("bbox", (max_gt, 4), np.int32),
+        ("mask", mask_shape + (max_gt,), bool),
+        ("rpn_match", (anchor_count,), np.int8),
+        ("anchor_iou_argmax", (anchor_count,), np.int16),
+    ]
+    key = "{};{}".format(config_fingerprint(config, SAMPLE_CONFIG_KEYS),
+                         dataset_fingerprint(dataset))
+    return SampleCache(cache_dir, key, len(dataset.image_info), fields)
+
+
+def load_rpn_sample(dataset, config, image_id, anchor_index, augment=False,
+                    augmentation=None, sample_cache=None, random_state=None):
+    """Loads an image with load_image_gt() and builds its RPN targets.
+
+    anchor_index: utils.AnchorGridIndex of the anchors of config.IMAGE_SHAPE
+    augment, augmentation: See load_image_gt().
+    sample_cache: Optional. A SampleCache from create_sample_cache(). If the
+        image isn't augmented, it's loaded from the cache, or stored in it.
+        Images that don't have the shape of config.IMAGE_SHAPE or have more
+        than MAX_GT_INSTANCES instances are not cached.
+    random_state: Optional. A np.random.RandomState for the augmentation and
+        the sampling of anchors. See load_image_gt().
+
+    Returns None if the image has no instances. Otherwise:
+    image, image_meta, class_ids, bbox, mask: See load_image_gt().
+    rpn_match, rpn_bbox: See build_rpn_targets().
+    """
+    anchors = anchor_index.anchors
+    if sample_cache is None or augment or augmentation:
+        image, image_meta, class_ids, bbox, mask = load_image_gt(
+            dataset, config, image_id, augment=augment,
+            augmentation=augmentation, use_mini_mask=config.USE_MINI_MASK,
+            random_state=random_state)
+        if not np.any(class_ids > 0):
+            return None
+        rpn_match, anchor_iou_argmax = match_rpn_anchors(
+            anchors, class_ids, bbox, anchor_index=anchor_index)
+    else:
+        cached = sample_cache.get(image_id)
+        if cached is not None:
+            count = cached["instance_count"]
+            image = cached["image"]
+            image_meta = cached["image_meta"]
+            class_ids = cached["class_ids"][:count]
+            bbox = cached["bbox"][:count]
+            mask = cached["mask"][..., :count]
+            rpn_match = cached["rpn_match"]
+            anchor_iou_argmax = cached["anchor_iou_argmax"]
+        else:
+            image, image_meta, class_ids, bbox, mask = load_image_gt(
+                dataset, config, image_id, use_mini_mask=config.USE_MINI_MASK)
+            rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+            anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int32)
+            if np.any(class_ids > 0):
+                rpn_match, anchor_iou_argmax = match_rpn_anchors(
+                    anchors, class_ids, bbox, anchor_index=anchor_index)
+            count = class_ids.shape[0]
+            if image.shape == tuple(config.IMAGE_SHAPE) and image.dtype == np.uint8 \
+                    and count <= config.MAX_GT_INSTANCES:
+                padding = config.MAX_GT_INSTANCES - count
+                sample_cache.put(
+                    image_id, image=image, image_meta=image_meta,
+                    instance_count=count,
+                    class_ids=np.pad(class_ids, (0, padding), "constant"),
+                    bbox=np.pad(bbox, ((0, padding), (0, 0)), "constant"),
+                    mask=np.pad(mask, ((0, 0), (0, 0), (0, padding)), "constant"),
+                    rpn_match=rpn_match, anchor_iou_argmax=anchor_iou_argmax)
+        if not np.any(class_ids > 0):
+            return None
+
+    rpn_match, rpn_bbox = sample_rpn_targets(anchors, rpn_match, anchor_iou_argmax,
+                                             bbox, config, random_state=random_state)
+    return image, image_meta, class_ids, bbox, mask, rpn_match, rpn_bbox
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, image_ids=None,
+                   sample_cache=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1663,6 +1945,10 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    image_ids: Optional. The IDs of the images to pick from. Defaults to all
+        the images of the dataset.
+    sample_cache: Optional. A SampleCache from create_sample_cache(). Images
+        that aren't augmented are loaded from it when possible.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -1684,18 +1970,19 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     """
     b = 0  # batch item index
     image_index = -1
-    image_ids = np.copy(dataset.image_ids)
+    image_ids = np.copy(dataset.image_ids if image_ids is None else image_ids)
     error_count = 0
     no_augmentation_sources = no_augmentation_sources or []
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
     backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchor_index = utils.AnchorGridIndex(config.RPN_ANCHOR_SCALES,
+                                         config.RPN_ANCHOR_RATIOS,
+                                         backbone_shapes,
+                                         config.BACKBONE_STRIDES,
+                                         config.RPN_ANCHOR_STRIDE)
+    anchors = anchor_index.anchors
 
     # Keras requires a generator to run indefinitely.
     while True:
@@ -1710,25 +1997,21 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # If the image source is not to be augmented pass None as augmentation
             if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
+                sample = load_rpn_sample(dataset, config, image_id, anchor_index,
+                                         augment=augment, augmentation=None,
+                                         sample_cache=sample_cache)
             else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
+                sample = load_rpn_sample(dataset, config, image_id, anchor_index,
+                                         augment=augment, augmentation=augmentation,
+                                         sample_cache=sample_cache)
 
             # Skip images that have no instances. This can happen in cases
             # where we train on a subset of classes and the image doesn't
             # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+            if sample is None:
                 continue
-
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
+            image, image_meta, gt_class_ids, gt_boxes, gt_masks, \
+                rpn_match, rpn_bbox = sample
 
             # Mask R-CNN Targets
             if random_rois:
@@ -1825,6 +2108,297 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+def data_loader_worker(dataset, config, image_ids, seed, slots, layout,
+                       free_slots, ready_slots, generator_kwargs):
+    """Runs data_generator() in a DataLoader process and copies the batches
+    it returns to the shared memory slots.
+    """
+    # Forked workers start with the same random state. Reseed them.
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    if generator_kwargs.get("augmentation"):
+        import imgaug
+        imgaug.seed(seed % 2 ** 31)
+
+    views = [DataLoader.slot_arrays(slot, layout) for slot in slots]
+    generator = data_generator(dataset, config, image_ids=image_ids,
+                               batch_size=config.BATCH_SIZE, **generator_kwargs)
+    try:
+        while True:
+            inputs, _ = next(generator)
+            slot = free_slots.get()
+            if slot is None:
+                break
+            for dst, src in zip(views[slot], inputs):
+                dst[...] = src
+            ready_slots.put((slot, None))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        ready_slots.put((None, traceback.format_exc()))
+
+
+class DataLoader():
+    """Runs data_generator() in multiple processes.
+
+    Each worker process loads a random share of the images of the dataset
+    and prepares complete batches. Finished batches are written to a ring of
+    preallocated shared memory slots, so only slot numbers go through the
+    process queues and the image, mask and target arrays are never pickled.
+
+    Only supports the inputs used by MaskRCNN.train(). Images must be of
+    config.IMAGE_SHAPE once resized, which is what data_generator() expects
+    anyway. Use it as a generator and call close() when done.
+
+    dataset: The Dataset object to pick data from
+    config: The model config object
+    shuffle: If True, shuffles the samples of each worker before every epoch
+    augmentation, no_augmentation_sources, sample_cache: See data_generator().
+    workers: Number of worker processes. Capped at the number of images so
+        every worker has at least one.
+    prefetch: Number of finished batches buffered in shared memory. Workers
+        wait when all slots are full.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augmentation=None,
+                 no_augmentation_sources=None, workers=4, prefetch=8,
+                 sample_cache=None):
+        assert workers > 0 and prefetch > 0
+        assert len(dataset.image_ids) > 0, "The dataset has no images."
+        workers = min(workers, len(dataset.image_ids))
+        self.layout = self.batch_layout(config)
+        self.slots = [multiprocessing.RawArray(
+            "b", sum(int(np.prod(shape)) * np.dtype(dtype).itemsize
+                     for shape, dtype in self.layout))
+            for _ in range(prefetch)]
+        self.views = [self.slot_arrays(slot, self.layout) for slot in self.slots]
+        self.free_slots = multiprocessing.Queue()
+        self.ready_slots = multiprocessing.Queue()
+        for i in range(prefetch):
+            self.free_slots.put(i)
+
+        # Give each worker a random share of the images
+        image_ids = np.random.permutation(dataset.image_ids)
+        generator_kwargs = {
+            "shuffle": shuffle,
+            "augmentation": augmentation,
+            "no_augmentation_sources": no_augmentation_sources,
+            "sample_cache": sample_cache,
+        }
+        self.workers = []
+        for i in range(workers):
+            worker = multiprocessing.Process(
+                target=data_loader_worker,
+                args=(dataset, config, image_ids[i::workers],
+                      np.random.randint(2 ** 31), self.slots, self.layout,
+                      self.free_slots, self.ready_slots, generator_kwargs),
+                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    @staticmethod
+    def batch_layout(config):
+        """Returns the shapes and dtypes of the input arrays of a training
+        batch, in the order returned by data_generator().
+        """
+        batch_size = config.BATCH_SIZE
+        anchor_count = utils.generate_pyramid_anchors(
+            config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+            compute_backbone_shapes(config, config.IMAGE_SHAPE),
+            config.BACKBONE_STRIDES, config.RPN_ANCHOR_STRIDE).shape[0]
+        if config.USE_MINI_MASK:
+            mask_shape = tuple(config.MINI_MASK_SHAPE)
+        else:
+            mask_shape = tuple(config.IMAGE_SHAPE[:2])
+        return [
+            ((batch_size,) + tuple(config.IMAGE_SHAPE), np.float32),
+            ((batch_size, config.IMAGE_META_SIZE), np.float64),
+            ((batch_size, anchor_count, 1), np.int32),
+            ((batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4), np.float64),
+            ((batch_size, config.MAX_GT_INSTANCES), np.int32),
+            ((batch_size, config.MAX_GT_INSTANCES, 4), np.int32),
+            ((batch_size,) + mask_shape + (config.MAX_GT_INSTANCES,), bool),
+        ]
+
+    @staticmethod
+    def slot_arrays(slot, layout):
+        """Returns NumPy views of the arrays of a shared memory slot."""
+        arrays = []
+        offset = 0
+        for shape, dtype in layout:
+            count = int(np.prod(shape))
+            arrays.append(np.frombuffer(slot, dtype=dtype, count=count,
+                                        offset=offset).reshape(shape))
+            offset += count * np.dtype(dtype).itemsize
+        return arrays
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                slot, error = self.ready_slots.get(timeout=1)
+                break
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A DataLoader worker process died.")
+        if error is not None:
+            raise RuntimeError("Error in DataLoader worker:\n" + error)
+        # Copy the batch out so the slot can be reused right away. Keras
+        # may hold on to batches in its own queue.
+        inputs = [np.copy(array) for array in self.views[slot]]
+        self.free_slots.put(slot)
+        return inputs, []
+
+    def close(self):
+        """Stops the worker processes."""
+        for _ in self.workers:
+            self.free_slots.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+
+class DataSequence(keras.utils.Sequence):
+    """A keras Sequence of training batches.
+
+    Images are picked from an endless series of passes over the dataset.
+    Each pass is shuffled with a seed made of seed and the pass number, and
+    each batch gets its own np.random.RandomState for augmentation and
+    target sampling. So a batch only depends on its global step, which is
+    epoch * steps + index, and the global random states of the process are
+    left alone. Keras workers can load batches in parallel and in
+    any order, and a training resumed at a later epoch continues from the
+    same position of the series.
+
+    dataset: The Dataset object to pick data from
+    config: The model config object
+    steps: Number of batches in an epoch
+    epoch: The epoch to start at. Pass MaskRCNN.epoch when resuming.
+    shuffle: If True, shuffles the images of every pass over the dataset
+    augmentation, no_augmentation_sources: See data_generator().
+    seed: Base random seed. Use the same seed to resume a training.
+    sample_cache: Optional. See data_generator().
+
+    Batches have the inputs returned by data_generator() with default
+    random_rois and detection_targets arguments.
+    """
+
+    def __init__(self, dataset, config, steps, epoch=0, shuffle=True,
+                 augmentation=None, no_augmentation_sources=None, seed=0,
+                 sample_cache=None):
+        self.dataset = dataset
+        self.config = config
+        self.steps = steps
+        self.epoch = epoch
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.no_augmentation_sources = no_augmentation_sources or []
+        self.seed = seed
+        self.sample_cache = sample_cache
+        self.image_ids = np.copy(dataset.image_ids)
+        self.layout = DataLoader.batch_layout(config)
+        backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
+        self.anchor_index = utils.AnchorGridIndex(config.RPN_ANCHOR_SCALES,
+                                                  config.RPN_ANCHOR_RATIOS,
+                                                  backbone_shapes,
+                                                  config.BACKBONE_STRIDES,
+                                                  config.RPN_ANCHOR_STRIDE)
+        # Image order of the last pass used. Consecutive batches are
+        # usually in the same pass.
+        self._pass = (None, None)
+
+    def __len__(self):
+        return self.steps
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def pass_image_ids(self, pass_index):
+        """Returns the image IDs of a pass over the dataset, in order."""
+        if self._pass[0] != pass_index:
+            image_ids = self.image_ids
+            if self.shuffle:
+                random_state = np.random.RandomState(
+                    (self.seed * 1000003 + pass_index) % 2 ** 32)
+                image_ids = random_state.permutation(image_ids)
+            self._pass = (pass_index, image_ids)
+        return self._pass[1]
+
+    def load_inputs(self, image_id, random_state):
+        """Loads an image and builds its targets. Returns None if the image
+        has no instances.
+
+        random_state: np.random.RandomState of the batch.
+        """
+        config = self.config
+        augmentation = self.augmentation
+        if self.dataset.image_info[image_id]['source'] in self.no_augmentation_sources:
+            augmentation = None
+        sample = load_rpn_sample(self.dataset, config, image_id, self.anchor_index,
+                                 augmentation=augmentation,
+                                 sample_cache=self.sample_cache,
+                                 random_state=random_state)
+        # Skip images that have no instances
+        if sample is None:
+            return None
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks, rpn_match, rpn_bbox = sample
+        # If more instances than fits in the array, sub-sample from them.
+        if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+            ids = random_state.choice(
+                np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+            gt_class_ids = gt_class_ids[ids]
+            gt_boxes = gt_boxes[ids]
+            gt_masks = gt_masks[:, :, ids]
+        return image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks
+
+    def __getitem__(self, index):
+        batch_size = self.config.BATCH_SIZE
+        step = self.epoch * self.steps + index
+        random_state = np.random.RandomState(
+            (self.seed * 1000003 + step) % 2 ** 32)
+
+        inputs = [np.zeros(shape, dtype) for shape, dtype in self.layout]
+        batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox, \
+            batch_gt_class_ids, batch_gt_boxes, batch_gt_masks = inputs
+        error_count = 0
+        for b in range(batch_size):
+            position = step * batch_size + b
+            image_id = self.pass_image_ids(position // len(self.image_ids))[
+                position % len(self.image_ids)]
+            while True:
+                try:
+                    sample = self.load_inputs(image_id, random_state)
+                except (GeneratorExit, KeyboardInterrupt):
+                    raise
+                except:
+                    # Log it and skip the image
+                    logging.exception("Error processing image {}".format(
+                        self.dataset.image_info[image_id]))
+                    error_count += 1
+                    if error_count > 5:
+                        raise
+                    sample = None
+                if sample is not None:
+                    break
+                # Replace skipped images with random ones. The random state
+                # is seeded, so the replacement is the same every time.
+                image_id = random_state.choice(self.image_ids)
+
+            image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes, gt_masks = sample
+            batch_image_meta[b] = image_meta
+            batch_rpn_match[b] = rpn_match[:, np.newaxis]
+            batch_rpn_bbox[b] = rpn_bbox
+            batch_images[b] = mold_image(image.astype(np.float32), self.config)
+            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
+            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
+            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
+        return inputs, []
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1897,7 +2471,7 @@ class MaskRCNN():
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
-        elif mode == "inference":
+        elif mode == "inference" and not config.GRAPH_ANCHORS:
             # Anchors in normalized coordinates
             input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
 
@@ -1944,6 +2518,11 @@ class MaskRCNN():
             anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
             # A hack to get around Keras's bad support for constants
             anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
+        elif config.GRAPH_ANCHORS:
+            # Generate the anchors from the actual shapes of the feature maps
+            anchors = KL.Lambda(
+                lambda x: generate_pyramid_anchors_graph(x[0], x[1:], config),
+                name="anchors")([input_image] + rpn_feature_maps)
         else:
             anchors = input_anchors
 
@@ -2063,7 +2642,16 @@ class MaskRCNN():
                                               config.NUM_CLASSES,
                                               train_bn=config.TRAIN_BN)
 
-            model = KM.Model([input_image, input_image_meta, input_anchors],
+            if config.GRAPH_UNMOLD:
+                # Pixel boxes and class masks. See unmold_detections()
+                detections, mrcnn_mask = DetectionUnmoldLayer(
+                    config, name="mrcnn_detection_unmold")(
+                    [detections, mrcnn_mask, input_image_meta])
+
+            inputs = [input_image, input_image_meta]
+            if not config.GRAPH_ANCHORS:
+                inputs.append(input_anchors)
+            model = KM.Model(inputs,
                              [detections, mrcnn_class, mrcnn_bbox,
                                  mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
                              name='mask_rcnn')
@@ -2145,6 +2733,16 @@ class MaskRCNN():
         if hasattr(f, 'close'):
             f.close()
 
+        # Remember the weights files for the detection cache. Partial loads
+        # add to the previous weights. The files are only hashed when the
+        # cache is used. See get_weights_fingerprint().
+        stat = os.stat(filepath)
+        weights_file = (filepath, stat.st_size, stat.st_mtime, by_name, exclude)
+        if by_name and getattr(self, "_weights_files", None):
+            self._weights_files = self._weights_files + [weights_file]
+        else:
+            self._weights_files = [weights_file]
+
         # Update the log directory
         self.set_log_dir(filepath)
 
@@ -2323,6 +2921,8 @@ class MaskRCNN():
             defined in the Dataset class.
         """
         assert self.mode == "training", "Create model in training mode."
+        assert self.config.IMAGE_RESIZE_MODE != "rect", \
+            "The rect resize mode is for inference only. Train with square."
 
         # Pre-defined layer regular expressions
         layer_regex = {
@@ -2338,14 +2938,6 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
-
         # Callbacks
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
@@ -2369,21 +2961,71 @@ class MaskRCNN():
         # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
         if os.name is 'nt':
             workers = 0
-        else:
+        elif self.config.DATA_LOADER_WORKERS is None:
             workers = multiprocessing.cpu_count()
+        else:
+            workers = self.config.DATA_LOADER_WORKERS
+
+        # Caches of un-augmented samples
+        train_cache = val_cache = None
+        if self.config.SAMPLE_CACHE_DIR:
+            train_cache = create_sample_cache(train_dataset, self.config,
+                                              self.config.SAMPLE_CACHE_DIR)
+            val_cache = create_sample_cache(val_dataset, self.config,
+                                            self.config.SAMPLE_CACHE_DIR)
+
+        # Data generators
+        if self.config.USE_DATA_SEQUENCE:
+            train_generator = DataSequence(train_dataset, self.config,
+                                           self.config.STEPS_PER_EPOCH,
+                                           epoch=self.epoch, shuffle=True,
+                                           augmentation=augmentation,
+                                           no_augmentation_sources=no_augmentation_sources,
+                                           sample_cache=train_cache)
+            val_generator = DataSequence(val_dataset, self.config,
+                                         self.config.VALIDATION_STEPS,
+                                         epoch=self.epoch, shuffle=True,
+                                         sample_cache=val_cache)
+        elif workers:
+            train_generator = DataLoader(train_dataset, self.config, shuffle=True,
+                                         augmentation=augmentation,
+                                         no_augmentation_sources=no_augmentation_sources,
+                                         workers=workers,
+                                         prefetch=self.config.DATA_LOADER_PREFETCH,
+                                         sample_cache=train_cache)
+            val_generator = DataLoader(val_dataset, self.config, shuffle=True,
+                                       workers=workers,
+                                       prefetch=self.config.DATA_LOADER_PREFETCH,
+                                       sample_cache=val_cache)
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             sample_cache=train_cache)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE,
+                                           sample_cache=val_cache)
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=1,
-            use_multiprocessing=False,
-        )
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                # Sequences can be loaded by Keras worker processes.
+                # Generators are read by one thread.
+                workers=workers if self.config.USE_DATA_SEQUENCE else 1,
+                use_multiprocessing=bool(self.config.USE_DATA_SEQUENCE and workers),
+            )
+        finally:
+            if workers and not self.config.USE_DATA_SEQUENCE:
+                train_generator.close()
+                val_generator.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2398,12 +3040,55 @@ class MaskRCNN():
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
         """
+        config = self.config
+        if not config.USE_FUSED_PREPROCESSING or \
+                config.IMAGE_RESIZE_MODE == "crop":
+            # Random crops can't be planned ahead. Use the generic path.
+            return self._mold_inputs_each(images)
+
+        # Plan the resizing first so the whole batch can be allocated once
+        geometries = [utils.compute_resize_geometry(
+            image.shape,
+            min_dim=config.IMAGE_MIN_DIM,
+            min_scale=config.IMAGE_MIN_SCALE,
+            max_dim=config.IMAGE_MAX_DIM,
+            mode=config.IMAGE_RESIZE_MODE) for image in images]
+        shapes = set(g[0] for g in geometries)
+        assert len(shapes) == 1, \
+            "Images of a batch must resize to the same shape. Got {}".format(shapes)
+        shape = shapes.pop() + images[0].shape[2:]
+        molded_images = np.empty((len(images),) + shape, dtype=np.float32)
+
+        # Resize, pad and normalize each image into its slot of the batch
+        def mold(i):
+            utils.mold_image_into(images[i], molded_images[i],
+                                  geometries[i][1], config.MEAN_PIXEL)
+        workers = min(config.PREPROCESS_WORKERS or 1, len(images))
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                list(executor.map(mold, range(len(images))))
+        else:
+            for i in range(len(images)):
+                mold(i)
+
+        # Build image_meta
+        image_metas = np.stack([compose_image_meta(
+            0, image.shape, shape, window, scale,
+            np.zeros([config.NUM_CLASSES], dtype=np.int32))
+            for image, (_, window, scale, _) in zip(images, geometries)])
+        windows = np.stack([g[1] for g in geometries])
+        return molded_images, image_metas, windows
+
+    def _mold_inputs_each(self, images):
+        """mold_inputs() without USE_FUSED_PREPROCESSING, and for the "crop"
+        resize mode. Resizes and molds each image separately with
+        utils.resize_image(), as in training.
+        """
         molded_images = []
         image_metas = []
         windows = []
         for image in images:
             # Resize image
-            # TODO: move resizing to mold_image()
             molded_image, window, scale, padding, crop = utils.resize_image(
                 image,
                 min_dim=self.config.IMAGE_MIN_DIM,
@@ -2426,23 +3111,32 @@ class MaskRCNN():
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, out=None):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)] in normalized coordinates
         mrcnn_mask: [N, height, width, num_classes]
+            If GRAPH_UNMOLD is set, the detection boxes are already in pixel
+            coordinates of the original image and mrcnn_mask is the
+            [N, height, width] masks of the predicted classes.
         original_image_shape: [H, W, C] Original image shape before resizing
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        out: Optional. A bool array [H, W, DETECTION_MAX_INSTANCES] to paste
+            the masks into. Pass the same array to reuse it across calls if
+            the previous results are not needed anymore. See
+            utils.unmold_masks().
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks. A
+            utils.CroppedMasks object if DETECTION_MASK_FORMAT is "cropped",
+            or a list of RLE dicts if it's "rle".
         """
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
@@ -2453,20 +3147,25 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
-
-        # Translate normalized coordinates in the resized image to pixel
-        # coordinates in the original image before resizing
-        window = utils.norm_boxes(window, image_shape[:2])
-        wy1, wx1, wy2, wx2 = window
-        shift = np.array([wy1, wx1, wy1, wx1])
-        wh = wy2 - wy1  # window height
-        ww = wx2 - wx1  # window width
-        scale = np.array([wh, ww, wh, ww])
-        # Convert boxes to normalized coordinates on the window
-        boxes = np.divide(boxes - shift, scale)
-        # Convert boxes to pixel coordinates on the original image
-        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+        if self.config.GRAPH_UNMOLD:
+            # The graph did the rest. See DetectionUnmoldLayer.
+            boxes = boxes.astype(np.int32)
+            masks = mrcnn_mask[:N]
+        else:
+            masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+
+            # Translate normalized coordinates in the resized image to pixel
+            # coordinates in the original image before resizing
+            window = utils.norm_boxes(window, image_shape[:2])
+            wy1, wx1, wy2, wx2 = window
+            shift = np.array([wy1, wx1, wy1, wx1])
+            wh = wy2 - wy1  # window height
+            ww = wx2 - wx1  # window width
+            scale = np.array([wh, ww, wh, ww])
+            # Convert boxes to normalized coordinates on the window
+            boxes = np.divide(boxes - shift, scale)
+            # Convert boxes to pixel coordinates on the original image
+            boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
 
         # Filter out detections with zero area. Happens in early training when
         # network weights are still random
@@ -2480,13 +3179,15 @@ class MaskRCNN():
             N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        if self.config.DETECTION_MASK_FORMAT == "cropped":
+            full_masks = utils.unmold_cropped_masks(masks, boxes,
+                                                    original_image_shape)
+        elif self.config.DETECTION_MASK_FORMAT == "rle":
+            full_masks = utils.unmold_cropped_masks(
+                masks, boxes, original_image_shape).to_rle()
+        else:
+            full_masks = utils.unmold_masks(masks, boxes, original_image_shape,
+                                            out=out)
 
         return boxes, class_ids, scores, full_masks
 
@@ -2499,7 +3200,7 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks. See DETECTION_MASK_FORMAT.
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2520,25 +3221,31 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Anchors are fed with the images unless the graph generates them
+        model_in = self._model_inputs(molded_images, image_metas)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
+            if len(model_in) > 2:
+                log("anchors", model_in[2])
         # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.keras_model.predict(model_in, verbose=0)
         # Process detections
+        return self._unmold_batch(images, detections, mrcnn_mask,
+                                  image_shape, windows)
+
+    def _unmold_batch(self, images, detections, mrcnn_mask, image_shape,
+                      windows):
+        """Runs unmold_detections() on each image of a batch and returns
+        the list of result dicts described in detect().
+        """
         results = []
         for i, image in enumerate(images):
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
+                                       image.shape, image_shape,
                                        windows[i])
             results.append({
                 "rois": final_rois,
@@ -2548,6 +3255,211 @@ class MaskRCNN():
             })
         return results
 
+    def detect_many(self, images, verbose=0):
+        """Runs the detection pipeline on any number of images.
+
+        detect() requires exactly BATCH_SIZE images because the inference
+        graph is built for a fixed batch size. This function splits the
+        images into batches of BATCH_SIZE, pads partial batches by
+        repeating their last image, and reuses the same graph for every batch.
+        Results of the padding images are dropped.
+
+        images: List (or any iterable) of images. Images are batched with
+            others that resize to the same shape, so they can have different
+            sizes in the "pad64" and "rect" resize modes.
+
+        Returns a list of dicts, one dict per image, in the same order as
+        the input. See detect() for the content of each dict.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+
+        return list(self.detect_stream(images, verbose=verbose))
+
+    def detect_stream(self, images, queue_size=2, verbose=0):
+        """Runs the detection pipeline on a stream of images, overlapping
+        the CPU and GPU work of consecutive batches.
+
+        Three stages run concurrently: a background thread molds batch
+        k+1, the calling thread runs the model on batch k, and another
+        background thread unmolds the detections of batch k-1. The stages
+        are connected by bounded queues, so at most about queue_size
+        batches are held in memory at each stage.
+
+        The model runs in the calling thread because the TensorFlow graph
+        and session are bound to it.
+
+        If DETECTION_CACHE_DIR is set, images that were processed before
+        with the same weights and config get their results from the cache.
+
+        images: Iterable of images, for example a generator that reads
+            them from disk. Images are batched with others that resize to
+            the same shape. See _iter_batches().
+        queue_size: Max number of batches waiting between two stages.
+
+        Yields one dict per image, in the same order as the input. See
+        detect() for the content of each dict.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        assert queue_size >= 1
+
+        molded = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up if the consumer went away, e.g. the generator was
+            # closed before the end of the stream
+            while not stop.is_set():
+                try:
+                    molded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        # Results found in the cache skip the model. See DETECTION_CACHE_DIR.
+        cache = self.get_detection_cache()
+        keys = {}  # input index -> cache key
+
+        def lookup():
+            for i, image in enumerate(images):
+                if cache is not None:
+                    key = cache.key(image)
+                    result = cache.get(key)
+                    if result is not None:
+                        if not put(("cached", [i], [result])):
+                            return
+                        continue
+                    keys[i] = key
+                yield i, image
+
+        def mold():
+            try:
+                for batch, count, indices in self._iter_batches(lookup(),
+                                                                indexed=True):
+                    if not put(("batch", batch, count, indices) +
+                               self.mold_inputs(batch)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        def unmold(indices, *args):
+            results = self._unmold_batch(*args)
+            if cache is not None:
+                for i, result in zip(indices, results):
+                    try:
+                        cache.put(keys.pop(i), result)
+                    except Exception:
+                        # E.g. disk full. The results are still valid.
+                        logging.exception("Error writing to the detection cache")
+            return results
+
+        molder = threading.Thread(target=mold, daemon=True)
+        molder.start()
+        unmolder = concurrent.futures.ThreadPoolExecutor(1)
+        pending = deque()
+        # Batches can complete out of order when images of different shapes
+        # are grouped. Keep the results until all earlier ones are out.
+        done = {}
+        next_index = 0
+        try:
+            while True:
+                item = molded.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if item[0] == "cached":
+                    done.update(zip(item[1], item[2]))
+                    while next_index in done:
+                        yield done.pop(next_index)
+                        next_index += 1
+                    continue
+                _, batch, count, indices, molded_images, image_metas, windows =\
+                    item
+                if verbose:
+                    log("Processing batch of {} images ({} padding)".format(
+                        count, len(batch) - count))
+                image_shape = molded_images[0].shape
+                detections, _, _, mrcnn_mask, _, _, _ =\
+                    self.keras_model.predict(
+                        self._model_inputs(molded_images, image_metas),
+                        verbose=0)
+                pending.append((indices, unmolder.submit(
+                    unmold, indices, batch[:count], detections, mrcnn_mask,
+                    image_shape, windows)))
+                # Hand out finished batches, and wait for the oldest one
+                # if too many are in flight
+                while pending and (pending[0][1].done() or
+                                   len(pending) > queue_size):
+                    indices, future = pending.popleft()
+                    done.update(zip(indices, future.result()))
+                    while next_index in done:
+                        yield done.pop(next_index)
+                        next_index += 1
+            while pending:
+                indices, future = pending.popleft()
+                done.update(zip(indices, future.result()))
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+        finally:
+            stop.set()
+            unmolder.shutdown(wait=False)
+
+    def _iter_batches(self, images, max_pending=None, indexed=False):
+        """Groups images into lists of BATCH_SIZE images that resize to the
+        same shape. This lets the "pad64" and "rect" resize modes batch
+        images of different sizes and aspect ratios.
+
+        Images wait in one group per molded shape until the group is full.
+        If more than max_pending images are waiting, the oldest group is
+        sent partially filled. Partial batches are padded by repeating
+        their last image so that they can run through the fixed-size graph.
+
+        max_pending: Defaults to 4 * BATCH_SIZE.
+        indexed: If True, images yields (index, image) tuples and the given
+            indices are returned instead of the positions in images.
+
+        Yields tuples (batch, count, indices) where count is the number of
+        real (non padding) images at the start of the batch and indices
+        are their positions in the input.
+        """
+        config = self.config
+        batch_size = config.BATCH_SIZE
+        max_pending = max_pending or 4 * batch_size
+        groups = OrderedDict()  # molded shape -> [(index, image), ...]
+
+        def flush(shape):
+            group = groups.pop(shape)
+            batch = [image for _, image in group]
+            count = len(batch)
+            batch = batch + [batch[-1]] * (batch_size - count)
+            return batch, count, [i for i, _ in group]
+
+        pending = 0
+        for i, image in (images if indexed else enumerate(images)):
+            if config.IMAGE_RESIZE_MODE == "crop":
+                shape = None
+            else:
+                shape = utils.compute_resize_geometry(
+                    image.shape,
+                    min_dim=config.IMAGE_MIN_DIM,
+                    min_scale=config.IMAGE_MIN_SCALE,
+                    max_dim=config.IMAGE_MAX_DIM,
+                    mode=config.IMAGE_RESIZE_MODE)[0]
+            groups.setdefault(shape, []).append((i, image))
+            pending += 1
+            if len(groups[shape]) == batch_size:
+                pending -= batch_size
+                yield flush(shape)
+            elif pending > max_pending:
+                oldest = next(iter(groups))
+                pending -= len(groups[oldest])
+                yield flush(oldest)
+        while groups:
+            yield flush(next(iter(groups)))
+
     def detect_molded(self, molded_images, image_metas, verbose=0):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
@@ -2560,11 +3472,13 @@ class MaskRCNN():
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks. See DETECTION_MASK_FORMAT.
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
             "Number of images must be equal to BATCH_SIZE"
+        assert not self.config.GRAPH_UNMOLD,\
+            "GRAPH_UNMOLD returns boxes in original image coordinates. Use detect()"
 
         if verbose:
             log("Processing {} images".format(len(molded_images)))
@@ -2577,19 +3491,17 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Anchors are fed with the images unless the graph generates them
+        model_in = self._model_inputs(molded_images, image_metas)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
-            log("anchors", anchors)
+            if len(model_in) > 2:
+                log("anchors", model_in[2])
         # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+            self.keras_model.predict(model_in, verbose=0)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2628,6 +3540,70 @@ class MaskRCNN():
             self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
         return self._anchor_cache[tuple(image_shape)]
 
+    def _model_inputs(self, molded_images, image_metas):
+        """Returns the list of inputs to feed to the inference model.
+
+        The anchors of the image shape are added as the third input, except
+        when the graph generates them itself. See GRAPH_ANCHORS.
+        """
+        model_in = [molded_images, image_metas]
+        if not self.config.GRAPH_ANCHORS:
+            anchors = self.get_anchors(molded_images[0].shape)
+            # Duplicate across the batch dimension because Keras requires it
+            anchors = np.broadcast_to(
+                anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+            model_in.append(anchors)
+        return model_in
+
+    def get_weights_fingerprint(self):
+        """Returns a string that identifies the weights loaded with
+        load_weights(), or None if they aren't known.
+
+        Each weights file is hashed the first time it's needed. Returns None
+        if a file was changed or deleted after it was loaded and before it
+        could be hashed.
+        """
+        if not getattr(self, "_weights_files", None):
+            return None
+        if not hasattr(self, "_weights_hashes"):
+            self._weights_hashes = {}
+        parts = []
+        for filepath, size, mtime, by_name, exclude in self._weights_files:
+            key = (filepath, size, mtime)
+            if key not in self._weights_hashes:
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    return None
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    return None
+                self._weights_hashes[key] = hash_file(filepath)
+            parts.append("{}:{}:{}".format(self._weights_hashes[key],
+                                           by_name, exclude))
+        return "+".join(parts)
+
+    def get_detection_cache(self):
+        """Returns the DetectionCache of the model, or None if caching is
+        disabled or the weights aren't known. See DETECTION_CACHE_DIR.
+
+        Cached results are keyed by the content of the weights files loaded
+        with load_weights() and the Config values that affect detections.
+        """
+        if not self.config.DETECTION_CACHE_DIR:
+            return None
+        weights_fingerprint = self.get_weights_fingerprint()
+        if weights_fingerprint is None:
+            return None
+        fingerprint = weights_fingerprint + ";" + \
+            config_fingerprint(self.config)
+        cache = getattr(self, "_detection_cache", None)
+        if cache is None or cache.fingerprint != fingerprint.encode("utf-8"):
+            cache = DetectionCache(self.config.DETECTION_CACHE_DIR,
+                                   fingerprint,
+                                   self.config.DETECTION_CACHE_SIZE)
+            self._detection_cache = cache
+        return cache
+
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
         tensor: TensorFlow symbolic tensor.
@@ -2708,13 +3684,7 @@ class MaskRCNN():
             molded_images, image_metas, _ = self.mold_inputs(images)
         else:
             molded_images = images
-        image_shape = molded_images[0].shape
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-        model_in = [molded_images, image_metas, anchors]
+        model_in = self._model_inputs(molded_images, image_metas)
 
         # Run inference
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
@@ -2862,6 +3832,61 @@ def norm_boxes_graph(boxes, shape):
     return tf.divide(boxes - shift, scale)
 
 
+def generate_anchors_graph(scale, ratios, shape, feature_stride,
+                           anchor_stride):
+    """Graph version of utils.generate_anchors(). Generates the anchors of
+    one level of the pyramid in the same order.
+
+    scale: Anchor size in pixels. Example: 32
+    ratios: 1D list of anchor ratios of width/height. Example: [0.5, 1, 2]
+    shape: [height, width] int tensor. Spatial shape of the feature map.
+    feature_stride: Stride of the feature map relative to the image in pixels.
+    anchor_stride: Stride of anchors on the feature map.
+
+    Returns: [anchors, (y1, x1, y2, x2)] in pixel coordinates
+    """
+    ratios = tf.constant(ratios, dtype=tf.float32)
+    # [ratios, (height, width)]
+    box_sizes = tf.stack([scale / tf.sqrt(ratios), scale * tf.sqrt(ratios)],
+                         axis=1)
+    # Enumerate shifts in feature space
+    shifts_y = tf.cast(tf.range(0, shape[0], anchor_stride) * feature_stride,
+                       tf.float32)
+    shifts_x = tf.cast(tf.range(0, shape[1], anchor_stride) * feature_stride,
+                       tf.float32)
+    shifts_x, shifts_y = tf.meshgrid(shifts_x, shifts_y)
+    # [positions, 1, (y, x)]
+    box_centers = tf.stack([tf.reshape(shifts_y, [-1]),
+                            tf.reshape(shifts_x, [-1])], axis=1)[:, None]
+    # Convert to corner coordinates (y1, x1, y2, x2)
+    boxes = tf.concat([box_centers - 0.5 * box_sizes,
+                       box_centers + 0.5 * box_sizes], axis=2)
+    return tf.reshape(boxes, [-1, 4])
+
+
+def generate_pyramid_anchors_graph(image, feature_maps, config):
+    """Graph version of MaskRCNN.get_anchors(). Generates the anchors of
+    all the levels of the pyramid for the actual shape of the input, so
+    they don't have to be fed to the model.
+
+    image: [batch, height, width, channels] input images.
+    feature_maps: List of the RPN feature maps [batch, height, width, depth],
+        one per scale in config.RPN_ANCHOR_SCALES.
+
+    Returns: [batch, anchors, (y1, x1, y2, x2)] in normalized coordinates.
+        The same anchors are repeated for each image of the batch.
+    """
+    anchors = []
+    for i, feature_map in enumerate(feature_maps):
+        anchors.append(generate_anchors_graph(
+            config.RPN_ANCHOR_SCALES[i], config.RPN_ANCHOR_RATIOS,
+            tf.shape(feature_map)[1:3], config.BACKBONE_STRIDES[i],
+            config.RPN_ANCHOR_STRIDE))
+    anchors = norm_boxes_graph(tf.concat(anchors, axis=0),
+                               tf.shape(image)[1:3])
+    return tf.tile(anchors[None], [tf.shape(image)[0], 1, 1])
+
+
 def denorm_boxes_graph(boxes, shape):
     """Converts boxes from normalized coordinates to pixel coordinates.
     boxes: [..., (y1, x1, y2, x2)] in normalized coordinates
@@ -10,16 +10,20 @@ Written by Waleed Abdulla
 import sys
 import os
 import math
+import functools
 import random
+import json
+import struct
+import concurrent.futures
 import numpy as np
 import tensorflow as tf
 import scipy
 import skimage.color
+import skimage.draw
 import skimage.io
 import skimage.transform
 import urllib.request
 import shutil
-import warnings
 
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
@@ -35,24 +39,63 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Project all the masks on each axis at once
+    rows = np.any(mask, axis=1)
+    cols = np.any(mask, axis=0)
+    return bboxes_from_projections(rows, cols)
+
+
+def extract_bboxes_packed(packed_mask, width):
+    """Compute bounding boxes from bit-packed masks.
+    packed_mask: [height, ceil(width / 8), num_instances] uint8. Masks
+        packed along the width axis with np.packbits(mask, axis=1).
+    width: Width of the masks before packing.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)].
+    """
+    rows = np.any(packed_mask, axis=1)
+    # OR the rows together and unpack only the result
+    cols = np.bitwise_or.reduce(packed_mask, axis=0)
+    cols = np.unpackbits(cols, axis=0)[:width].astype(bool)
+    return bboxes_from_projections(rows, cols)
+
+
+def extract_bboxes_from_labels(labels, num_labels=None):
+    """Compute bounding boxes from a label map.
+    labels: [height, width] integer array. Pixels of instance i have the
+        value i + 1, and background pixels are 0.
+    num_labels: Number of instances. Defaults to the max label.
+
+    Returns: bbox array [num_labels, (y1, x1, y2, x2)]. Labels that don't
+        appear in the map get a box of zeros.
+    """
+    if num_labels is None:
+        num_labels = int(labels.max()) if labels.size else 0
+    boxes = np.zeros([num_labels, 4], dtype=np.int32)
+    slices = scipy.ndimage.find_objects(labels.astype(np.int32), num_labels)
+    for i, s in enumerate(slices):
+        if s is not None:
+            boxes[i] = [s[0].start, s[1].start, s[0].stop, s[1].stop]
+    return boxes
+
+
+def bboxes_from_projections(rows, cols):
+    """Compute bounding boxes from the projections of masks on each axis.
+    rows: [height, num_instances] bool. True if the row has mask pixels.
+    cols: [width, num_instances] bool. True if the column has mask pixels.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)]. Empty masks
+        get a box of zeros. They might happen due to resizing or cropping.
+    """
+    # argmax returns the first True. On the reversed arrays, the last one.
+    y1 = np.argmax(rows, axis=0)
+    y2 = rows.shape[0] - np.argmax(rows[::-1], axis=0)
+    x1 = np.argmax(cols, axis=0)
+    x2 = cols.shape[0] - np.argmax(cols[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Set bbox to zeros
+    boxes[~np.any(rows, axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -76,33 +119,144 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def compute_overlaps(boxes1, boxes2, chunk_size=8192):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    chunk_size: Number of rows of boxes1 processed at once. Bounds the
+        size of the temporary arrays.
 
     For better performance, pass the largest set first and the smaller second.
-    """
-    # Areas of anchors and GT boxes
-    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
-    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
-    # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
-    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    Returns: [boxes1 count, boxes2 count] float32 matrix of IoU values.
+    """
+    overlaps = np.empty((boxes1.shape[0], boxes2.shape[0]), dtype=np.float32)
+    for start, chunk in iter_overlaps(boxes1, boxes2, chunk_size):
+        overlaps[start:start + chunk.shape[0]] = chunk
     return overlaps
 
 
+def compute_overlaps_max(boxes1, boxes2, chunk_size=8192):
+    """Computes the best IoU match of each box of both sets without
+    keeping the full IoU matrix in memory. Use it instead of
+    compute_overlaps() when only the max and argmax are needed, for
+    example to match ~260k anchors to the GT boxes.
+
+    boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    chunk_size: Number of rows of boxes1 processed at once.
+
+    Ties are broken like np.argmax(), with the first occurrence.
+
+    Returns:
+    max1: [boxes1 count] float32 max IoU of each box of boxes1.
+    argmax1: [boxes1 count] index of the best box of boxes2 for each box
+        of boxes1.
+    max2: [boxes2 count] float32 max IoU of each box of boxes2.
+    argmax2: [boxes2 count] index of the best box of boxes1 for each box
+        of boxes2.
+    """
+    n1, n2 = boxes1.shape[0], boxes2.shape[0]
+    max1 = np.zeros([n1], dtype=np.float32)
+    argmax1 = np.zeros([n1], dtype=np.int64)
+    max2 = np.full([n2], -1, dtype=np.float32)
+    argmax2 = np.zeros([n2], dtype=np.int64)
+    if n2 == 0:
+        return max1, argmax1, max2, argmax2
+    for start, chunk in iter_overlaps(boxes1, boxes2, chunk_size):
+        rows = np.arange(chunk.shape[0])
+        # Rows
+        argmax1[start:start + chunk.shape[0]] = ix = np.argmax(chunk, axis=1)
+        max1[start:start + chunk.shape[0]] = chunk[rows, ix]
+        # Columns. Keep the earlier chunk on ties.
+        ix = np.argmax(chunk, axis=0)
+        chunk_max = chunk[ix, np.arange(n2)]
+        better = chunk_max > max2
+        max2[better] = chunk_max[better]
+        argmax2[better] = ix[better] + start
+    return max1, argmax1, max2, argmax2
+
+
+def iter_overlaps(boxes1, boxes2, chunk_size=8192):
+    """Computes the IoU overlaps of boxes1 and boxes2 in chunks of rows.
+    Used by compute_overlaps() and compute_overlaps_max().
+
+    Yields tuples (start, overlaps) where overlaps is the float32
+    [chunk rows, boxes2 count] IoU matrix of boxes1[start:start + rows].
+    """
+    boxes2 = boxes2.astype(np.float32)
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    for start in range(0, boxes1.shape[0], chunk_size):
+        b1 = boxes1[start:start + chunk_size].astype(np.float32)
+        area1 = (b1[:, 2] - b1[:, 0]) * (b1[:, 3] - b1[:, 1])
+        # Intersections [chunk rows, boxes2 count]
+        h = np.minimum(b1[:, None, 2], boxes2[None, :, 2])
+        h -= np.maximum(b1[:, None, 0], boxes2[None, :, 0])
+        np.maximum(h, 0, out=h)
+        w = np.minimum(b1[:, None, 3], boxes2[None, :, 3])
+        w -= np.maximum(b1[:, None, 1], boxes2[None, :, 1])
+        np.maximum(w, 0, out=w)
+        intersection = np.multiply(h, w, out=h)
+        # IoU = intersection / union
+        union = np.add(area1[:, None], area2[None, :], out=w)
+        union -= intersection
+        yield start, np.divide(intersection, union, out=intersection)
+
+
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances] arrays, CroppedMasks objects
+        or lists of RLE dicts.
     """
-    
+    if isinstance(masks1, list) or isinstance(masks2, list):
+        return compute_overlaps_rle(as_rle_masks(masks1), as_rle_masks(masks2))
+    if isinstance(masks1, CroppedMasks) or isinstance(masks2, CroppedMasks):
+        if not isinstance(masks1, CroppedMasks):
+            masks1 = CroppedMasks.from_dense(masks1)
+        if not isinstance(masks2, CroppedMasks):
+            masks2 = CroppedMasks.from_dense(masks2)
+        return compute_overlaps_cropped_masks(masks1, masks2)
+
     # If either set of masks is empty return empty result
-    if masks1.shape[0] == 0 or masks2.shape[0] == 0:
-        return np.zeros((masks1.shape[0], masks2.shape[-1]))
+    if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
+        return np.zeros((masks1.shape[-1], masks2.shape[-1]))
+    if masks1.dtype != bool:
+        masks1 = masks1 > .5
+    if masks2.dtype != bool:
+        masks2 = masks2 > .5
+    boxes1 = extract_bboxes(masks1)
+    boxes2 = extract_bboxes(masks2)
+    # Large masks that mostly overlap, such as walls and floors, are
+    # compared faster with one dense matrix product.
+    intersection_area = np.sum(compute_box_intersection_areas(boxes1, boxes2))
+    dense_area = masks1.shape[0] * masks1.shape[1] * masks1.shape[-1] * masks2.shape[-1]
+    if intersection_area > PACKED_OVERLAPS_MAX_RATIO * dense_area:
+        return compute_overlaps_dense_masks(masks1, masks2)
+    # Compare bit-packed masks, and only where their boxes intersect
+    return compute_overlaps_packed_masks(pack_masks(masks1, boxes1),
+                                         pack_masks(masks2, boxes2))
+
+
+# Masks are compared bit-packed while the summed area of the intersections
+# of their boxes is below this fraction of height * width * N1 * N2. Per
+# pixel, the packed comparison costs about 5 to 10 times more than one
+# pair of the dense matrix product.
+PACKED_OVERLAPS_MAX_RATIO = 0.1
+
+
+def compute_box_intersection_areas(boxes1, boxes2):
+    """Returns the [N1, N2] areas of the intersections of two sets of
+    [N, (y1, x1, y2, x2)] boxes.
+    """
+    h = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2]) - \
+        np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    w = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3]) - \
+        np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    return np.maximum(h, 0).astype(np.int64) * np.maximum(w, 0)
+
+
+def compute_overlaps_dense_masks(masks1, masks2):
+    """Computes IoU overlaps between two sets of [Height, Width, instances]
+    masks with one matrix product over all their pixels.
+    """
     # flatten masks and compute their areas
     masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
     masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
@@ -112,8 +266,74 @@ def compute_overlaps_masks(masks1, masks2):
     # intersections and union
     intersections = np.dot(masks1.T, masks2)
     union = area1[:, None] + area2[None, :] - intersections
-    overlaps = intersections / union
+    return np.where(union > 0, intersections / np.maximum(union, 1), 0)
+
+
+# Number of set bits of each byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
 
+def popcount(array):
+    """Returns the total number of set bits of a uint8 array."""
+    if hasattr(np, "bitwise_count"):
+        # NumPy 2.0+
+        return np.bitwise_count(array).sum(dtype=np.int64)
+    return POPCOUNT_TABLE[array].sum(dtype=np.int64)
+
+
+def pack_masks(masks, boxes=None):
+    """Bit-packs a stack of masks for compute_overlaps_packed_masks().
+    Only the bounding box of each mask is packed, widened to whole bytes
+    so the packed crops of all masks stay aligned to the same byte columns.
+    masks: [height, width, N]. Pixels > 0.5 are set.
+    boxes: Optional. [N, (y1, x1, y2, x2)] boxes of the masks, if they were
+        already computed with extract_bboxes().
+
+    Returns a tuple of:
+    crops: List of N [y2 - y1, ceil(x2 / 8) - x1 // 8] uint8 arrays.
+    boxes: [N, (y1, x1, y2, x2)] bounding boxes of the masks.
+    areas: [N] number of set pixels of each mask.
+    """
+    if masks.dtype != bool:
+        masks = masks > .5
+    if boxes is None:
+        boxes = extract_bboxes(masks)
+    crops = []
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        crops.append(np.packbits(masks[y1:y2, x1 // 8 * 8:x2, i], axis=1))
+    areas = np.array([popcount(c) for c in crops], dtype=np.int64)
+    return crops, boxes, areas
+
+
+def compute_overlaps_packed_masks(masks1, masks2):
+    """Computes IoU overlaps between two sets of bit-packed masks.
+    masks1, masks2: Tuples (crops, boxes, areas) returned by pack_masks().
+
+    Only the pairs with intersecting boxes are compared, and only on the
+    bytes that cover the intersection of their boxes. Bits outside of the
+    box of a mask are zero, so the extra bits of the partial bytes at the
+    edges don't change the count.
+
+    Returns: [N1, N2] IoU overlaps.
+    """
+    crops1, b1, area1 = masks1
+    crops2, b2, area2 = masks2
+    overlaps = np.zeros((len(crops1), len(crops2)))
+    # Intersection of every pair of boxes
+    y1 = np.maximum(b1[:, None, 0], b2[None, :, 0])
+    x1 = np.maximum(b1[:, None, 1], b2[None, :, 1])
+    y2 = np.minimum(b1[:, None, 2], b2[None, :, 2])
+    x2 = np.minimum(b1[:, None, 3], b2[None, :, 3])
+    for i, j in zip(*np.where((y2 > y1) & (x2 > x1))):
+        # Bytes that cover the intersection, relative to each crop
+        c1, c2 = x1[i, j] // 8, (x2[i, j] + 7) // 8
+        oy1, ox1 = b1[i, 0], b1[i, 1] // 8
+        oy2, ox2 = b2[j, 0], b2[j, 1] // 8
+        both = (crops1[i][y1[i, j] - oy1:y2[i, j] - oy1, c1 - ox1:c2 - ox1] &
+                crops2[j][y1[i, j] - oy2:y2[i, j] - oy2, c1 - ox2:c2 - ox2])
+        intersection = popcount(both)
+        if intersection:
+            overlaps[i, j] = intersection / (area1[i] + area2[j] - intersection)
     return overlaps
 
 
@@ -122,6 +342,8 @@ def non_max_suppression(boxes, scores, threshold):
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+
+    Returns: int32 indices of the kept boxes, sorted by score (highest first).
     """
     assert boxes.shape[0] > 0
     if boxes.dtype.kind != "f":
@@ -136,24 +358,129 @@ def non_max_suppression(boxes, scores, threshold):
 
     # Get indicies of boxes sorted by scores (highest first)
     ixs = scores.argsort()[::-1]
-
+    # Sort the boxes once, so that lower scored boxes have higher ranks
+    boxes = boxes[ixs]
+    area = area[ixs]
+    # Ranks sorted by x1, to find the boxes that can overlap a given box
+    # with a binary search instead of checking all of them
+    x_order = np.argsort(boxes[:, 1], kind="stable")
+    x1_sorted = boxes[x_order, 1]
+    max_width = np.max(boxes[:, 3] - boxes[:, 1])
+
+    # Suppression mask by rank. Boxes are flagged rather than deleted so
+    # that no array gets reallocated in the loop.
+    suppressed = np.zeros([len(ixs)], dtype=bool)
     pick = []
-    while len(ixs) > 0:
+    for i in range(len(ixs)):
+        if suppressed[i]:
+            continue
         # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
+        pick.append(ixs[i])
+        # Every now and then, drop the suppressed and already visited boxes
+        # from the search arrays so they keep shrinking
+        if len(pick) % 32 == 0:
+            keep = ~suppressed[x_order] & (x_order > i)
+            x_order = x_order[keep]
+            x1_sorted = x1_sorted[keep]
+        # Only boxes with x1 in (x1 - max_width, x2) can intersect box i
+        lo = np.searchsorted(x1_sorted, boxes[i, 1] - max_width, side="right")
+        hi = np.searchsorted(x1_sorted, boxes[i, 3], side="left")
+        candidates = x_order[lo:hi]
+        candidates = candidates[candidates > i]
+        if candidates.shape[0] == 0:
+            continue
+        # Suppress lower scored boxes with IoU over the threshold
+        iou = compute_iou(boxes[i], boxes[candidates], area[i], area[candidates])
+        suppressed[candidates[iou > threshold]] = True
     return np.array(pick, dtype=np.int32)
 
 
+def batched_non_max_suppression(boxes, scores, threshold, class_ids):
+    """Performs non-maximum suppression separately for each class, in one
+    pass. Boxes of different classes never suppress each other.
+
+    boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores: 1-D array of box scores.
+    threshold: Float. IoU threshold to use for filtering.
+    class_ids: [N] Integer class ID of each box.
+
+    Returns: int32 indices of the kept boxes, sorted by score (highest first).
+    """
+    assert boxes.shape[0] > 0
+    boxes = boxes.astype(np.float64)
+    # Move the boxes of each class to their own area of the plane so that
+    # they can't overlap the boxes of other classes
+    offset = boxes.max() - boxes.min() + 1
+    shift = (class_ids - np.min(class_ids)).astype(np.float64) * offset
+    boxes = boxes + shift[:, np.newaxis]
+    return non_max_suppression(boxes, scores, threshold)
+
+
+def soft_non_max_suppression(boxes, scores, threshold, sigma=0.5,
+                             method="gaussian", score_threshold=0.001):
+    """Performs Soft-NMS (Bodla et al., 2017). Instead of removing the boxes
+    that overlap a picked box, their scores are decayed based on the IoU.
+
+    Takes the arguments of non_max_suppression(), but unlike it and
+    batched_non_max_suppression(), which return the kept indices only,
+    returns a tuple (indices, scores), since the scores change.
+
+    boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores: 1-D array of box scores.
+    threshold: Float. IoU threshold of the "linear" method. Scores of boxes
+        with a higher IoU are multiplied by (1 - IoU).
+    sigma: The "gaussian" method multiplies scores by exp(-IoU^2 / sigma).
+    method: "linear" or "gaussian".
+    score_threshold: Boxes with decayed scores below this are dropped.
+
+    Returns:
+    indices: int32 indices of the kept boxes, sorted by new score.
+    scores: [len(indices)] float32 decayed scores of the kept boxes.
+    """
+    assert method in ["linear", "gaussian"]
+    assert boxes.shape[0] > 0
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    # Boxes sorted by x1, to find the boxes that can overlap a given box.
+    # Boxes that don't intersect the picked box keep their score.
+    x_order = np.argsort(boxes[:, 1], kind="stable")
+    x1_sorted = boxes[x_order, 1]
+    max_width = np.max(boxes[:, 3] - boxes[:, 1])
+
+    # Current scores. Picked and dropped boxes are set to -inf.
+    current = scores.astype(np.float32)
+    current[current < score_threshold] = -np.inf
+    pick = []
+    pick_scores = []
+    while True:
+        # Pick the box with the highest current score
+        i = np.argmax(current)
+        if current[i] == -np.inf:
+            break
+        pick.append(i)
+        pick_scores.append(current[i])
+        current[i] = -np.inf
+        # Decay the scores of the boxes that intersect it
+        lo = np.searchsorted(x1_sorted, boxes[i, 1] - max_width, side="right")
+        hi = np.searchsorted(x1_sorted, boxes[i, 3], side="left")
+        candidates = x_order[lo:hi]
+        candidates = candidates[current[candidates] > -np.inf]
+        if candidates.shape[0] == 0:
+            continue
+        iou = compute_iou(boxes[i], boxes[candidates], area[i], area[candidates])
+        if method == "linear":
+            decay = np.where(iou > threshold, 1 - iou, 1)
+        else:
+            decay = np.exp(-(iou * iou) / sigma)
+        decayed = current[candidates] * decay
+        # Drop boxes with negligible scores
+        decayed[decayed < score_threshold] = -np.inf
+        current[candidates] = decayed
+    return (np.array(pick, dtype=np.int32),
+            np.array(pick_scores, dtype=np.float32))
+
+
 def apply_box_deltas(boxes, deltas):
     """Applies the given deltas to the given boxes.
     boxes: [N, (y1, x1, y2, x2)]. Note that (y2, x2) is outside the box.
@@ -204,10 +531,14 @@ def box_refinement_graph(box, gt_box):
     return result
 
 
-def box_refinement(box, gt_box):
+def box_refinement(box, gt_box, std_dev=None):
     """Compute refinement needed to transform box to gt_box.
     box and gt_box are [N, (y1, x1, y2, x2)]. (y2, x2) is
     assumed to be outside the box.
+    std_dev: Optional [4] array. If given, the deltas are divided by it
+        to normalize them. E.g. config.RPN_BBOX_STD_DEV or BBOX_STD_DEV.
+
+    Returns: [N, (dy, dx, log(dh), log(dw))] float32 deltas.
     """
     box = box.astype(np.float32)
     gt_box = gt_box.astype(np.float32)
@@ -227,7 +558,10 @@ def box_refinement(box, gt_box):
     dh = np.log(gt_height / height)
     dw = np.log(gt_width / width)
 
-    return np.stack([dy, dx, dh, dw], axis=1)
+    deltas = np.stack([dy, dx, dh, dw], axis=1)
+    if std_dev is not None:
+        deltas /= np.asarray(std_dev, dtype=np.float32)
+    return deltas
 
 
 ############################################################
@@ -392,8 +726,183 @@ class Dataset(object):
         class_ids = np.empty([0], np.int32)
         return mask, class_ids
 
+    def load_polygons(self, image_id):
+        """Load the instances of the given image as polygons, if the
+        dataset stores them that way.
+
+        When mini masks are used, load_image_gt() rasterizes polygons
+        straight into mini masks instead of calling load_mask(), and
+        augments them by moving their vertices. Override this method to
+        return the polygons of your dataset.
+
+        Returns None if the instances aren't polygons. Otherwise:
+            polygons: List of [vertex_count, (y, x)] arrays of vertices in
+                pixel coordinates of the image, one polygon per instance.
+            class_ids: a 1D array of class IDs of the instances.
+        """
+        return None
+
+
+# JPEG start of frame markers. They hold the image size.
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_image_size(path):
+    """Reads the size of a JPEG or PNG image from its header, without
+    decoding the image.
+
+    Returns (height, width), or None if the file isn't a JPEG or PNG image
+    or the size isn't in the header.
+    """
+    with open(path, "rb") as f:
+        head = f.read(24)
+        # PNG: The IHDR chunk comes first, right after the signature
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", head[16:24])
+            return height, width
+        if head[:2] != b"\xff\xd8":
+            return None
+        # JPEG: Walk the marker segments up to the start of frame
+        f.seek(2)
+        while True:
+            byte = f.read(1)
+            if not byte:
+                return None
+            if byte != b"\xff":
+                continue
+            marker = f.read(1)
+            while marker == b"\xff":
+                marker = f.read(1)
+            if not marker:
+                return None
+            marker = ord(marker)
+            # Markers without a segment
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            length = struct.unpack(">H", length)[0]
+            if marker in JPEG_SOF_MARKERS:
+                segment = f.read(5)
+                if len(segment) < 5:
+                    return None
+                height, width = struct.unpack(">HH", segment[1:5])
+                # A height of 0 means it's defined later in the file
+                return (height, width) if height else None
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_sizes(paths, index_path=None, workers=8):
+    """Returns the (height, width) of a list of images.
+
+    Sizes are read from the JPEG and PNG headers with read_image_size(),
+    using a pool of threads. Other images are decoded to get their size.
+
+    index_path: Optional. A JSON file to store the sizes in. Images that
+        are in it and didn't change since (same file size and modification
+        time) are not read again. It's updated if any size was read.
+    workers: Number of threads.
+    """
+    index = {}
+    if index_path and os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    def size(path):
+        stat = os.stat(path)
+        entry = index.get(os.path.basename(path))
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry, False
+        shape = read_image_size(path)
+        if shape is None:
+            shape = skimage.io.imread(path).shape[:2]
+        return {"height": int(shape[0]), "width": int(shape[1]),
+                "size": stat.st_size, "mtime": stat.st_mtime}, True
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        entries = list(executor.map(size, paths))
+
+    if index_path and any(changed for _, changed in entries):
+        for path, (entry, _) in zip(paths, entries):
+            index[os.path.basename(path)] = entry
+        # Write to a temporary file first so readers never see partial files
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return [(entry["height"], entry["width"]) for entry, _ in entries]
+
+
+def compute_resize_geometry(image_shape, min_dim=None, max_dim=None,
+                            min_scale=None, mode="square"):
+    """Computes how resize_image() resizes and pads an image of the given
+    shape, without touching any pixels.
+
+    image_shape: [height, width, ...] of the source image.
+    min_dim, max_dim, min_scale, mode: Same as in resize_image(). In "crop"
+        mode, the geometry is that of the scaled image before the random
+        crop is picked.
+
+    Returns:
+    shape: (height, width) of the output image, including the padding.
+    window: (y1, x1, y2, x2) of the resized image in the output image.
+    scale: The scale factor used to resize the image
+    padding: Padding added to the image [(top, bottom), (left, right), (0, 0)]
+    """
+    h, w = image_shape[:2]
+    scale = 1
+    if mode == "none":
+        return (h, w), (0, 0, h, w), scale, [(0, 0), (0, 0), (0, 0)]
+    if mode not in ["square", "pad64", "rect", "crop"]:
+        raise Exception("Mode {} not supported".format(mode))
+
+    # Scale?
+    if min_dim:
+        # Scale up but not down
+        scale = max(1, min_dim / min(h, w))
+    if min_scale and scale < min_scale:
+        scale = min_scale
+
+    # Does it exceed max dim?
+    if max_dim and mode in ["square", "rect"]:
+        image_max = max(h, w)
+        if round(image_max * scale) > max_dim:
+            scale = max_dim / image_max
+
+    # Size of the resized image
+    if scale != 1:
+        h, w = round(h * scale), round(w * scale)
+
+    # Need padding?
+    top_pad = bottom_pad = left_pad = right_pad = 0
+    if mode == "square":
+        top_pad = (max_dim - h) // 2
+        bottom_pad = max_dim - h - top_pad
+        left_pad = (max_dim - w) // 2
+        right_pad = max_dim - w - left_pad
+    elif mode in ["pad64", "rect"]:
+        # Both sides must be divisible by 64
+        if mode == "pad64":
+            assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
+        # Height
+        if h % 64 > 0:
+            max_h = h - (h % 64) + 64
+            top_pad = (max_h - h) // 2
+            bottom_pad = max_h - h - top_pad
+        # Width
+        if w % 64 > 0:
+            max_w = w - (w % 64) + 64
+            left_pad = (max_w - w) // 2
+            right_pad = max_w - w - left_pad
+    padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
+    window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    shape = (h + top_pad + bottom_pad, w + left_pad + right_pad)
+    return shape, window, scale, padding
+
 
-def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square",
+                 random_state=None):
     """Resizes an image keeping the aspect ratio unchanged.
 
     min_dim: if provided, resizes the image such that it's smaller
@@ -411,10 +920,15 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
                before padding. max_dim is ignored in this mode.
                The multiple of 64 is needed to ensure smooth scaling of feature
                maps up and down the 6 levels of the FPN pyramid (2**6=64).
+        rect: Scales like square mode, so the long side doesn't exceed
+              max_dim, but then pads each side to a multiple of 64 instead
+              of padding to a square. Less padding for non-square images.
         crop: Picks random crops from the image. First, scales the image based
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
               max_dim is not used in this mode.
+    random_state: Optional. A np.random.RandomState to pick the crop with.
+        Uses the random module if not provided.
 
     Returns:
     image: the resized image
@@ -437,127 +951,294 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     if mode == "none":
         return image, window, scale, padding, crop
 
-    # Scale?
-    if min_dim:
-        # Scale up but not down
-        scale = max(1, min_dim / min(h, w))
-    if min_scale and scale < min_scale:
-        scale = min_scale
-
-    # Does it exceed max dim?
-    if max_dim and mode == "square":
-        image_max = max(h, w)
-        if round(image_max * scale) > max_dim:
-            scale = max_dim / image_max
+    _, window, scale, padding = compute_resize_geometry(
+        image.shape, min_dim=min_dim, max_dim=max_dim, min_scale=min_scale,
+        mode=mode)
 
     # Resize image using bilinear interpolation
     if scale != 1:
         image = skimage.transform.resize(
-            image, (round(h * scale), round(w * scale)),
+            image, (window[2] - window[0], window[3] - window[1]),
             order=1, mode="constant", preserve_range=True)
 
     # Need padding or cropping?
-    if mode == "square":
-        # Get new height and width
-        h, w = image.shape[:2]
-        top_pad = (max_dim - h) // 2
-        bottom_pad = max_dim - h - top_pad
-        left_pad = (max_dim - w) // 2
-        right_pad = max_dim - w - left_pad
-        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-        image = np.pad(image, padding, mode='constant', constant_values=0)
-        window = (top_pad, left_pad, h + top_pad, w + left_pad)
-    elif mode == "pad64":
-        h, w = image.shape[:2]
-        # Both sides must be divisible by 64
-        assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
-        # Height
-        if h % 64 > 0:
-            max_h = h - (h % 64) + 64
-            top_pad = (max_h - h) // 2
-            bottom_pad = max_h - h - top_pad
-        else:
-            top_pad = bottom_pad = 0
-        # Width
-        if w % 64 > 0:
-            max_w = w - (w % 64) + 64
-            left_pad = (max_w - w) // 2
-            right_pad = max_w - w - left_pad
-        else:
-            left_pad = right_pad = 0
-        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
+    if mode in ["square", "pad64", "rect"]:
         image = np.pad(image, padding, mode='constant', constant_values=0)
-        window = (top_pad, left_pad, h + top_pad, w + left_pad)
     elif mode == "crop":
         # Pick a random crop
         h, w = image.shape[:2]
-        y = random.randint(0, (h - min_dim))
-        x = random.randint(0, (w - min_dim))
+        if random_state is None:
+            y = random.randint(0, (h - min_dim))
+            x = random.randint(0, (w - min_dim))
+        else:
+            y = random_state.randint(0, (h - min_dim) + 1)
+            x = random_state.randint(0, (w - min_dim) + 1)
         crop = (y, x, min_dim, min_dim)
         image = image[y:y + min_dim, x:x + min_dim]
         window = (0, 0, min_dim, min_dim)
-    else:
-        raise Exception("Mode {} not supported".format(mode))
     return image.astype(image_dtype), window, scale, padding, crop
 
 
+def mold_image_into(image, out, window, mean_pixel):
+    """Resizes, pads and normalizes an image in one pass, writing the
+    result straight into a preallocated float32 array.
+
+    This is the fused equivalent of resize_image() followed by
+    model.mold_image(). It reads the source image (typically uint8) only
+    once and never creates a float64 or full size temporary copy. The
+    resampling uses the separable bilinear plans of compute_resize_plan(),
+    which differ from the skimage resize of resize_image() at the image
+    edges and when downscaling. See Config.USE_FUSED_PREPROCESSING.
+
+    image: [height, width, channels] source image.
+    out: [H, W, channels] float32 array to write into. Typically one slot
+        of a batch array.
+    window: (y1, x1, y2, x2) area of out to resize the image into. See
+        compute_resize_geometry(). The rest of out is padding.
+    mean_pixel: [channels] Mean pixel to subtract. Padding is set to
+        -mean_pixel, which is what zero padding becomes once molded.
+
+    Returns out.
+    """
+    y1, x1, y2, x2 = window
+    mean_pixel = np.asarray(mean_pixel, dtype=out.dtype)
+    h, w = image.shape[:2]
+    new_h, new_w = y2 - y1, x2 - x1
+
+    # Padding
+    out[:y1] = -mean_pixel
+    out[y2:] = -mean_pixel
+    out[y1:y2, :x1] = -mean_pixel
+    out[y1:y2, x2:] = -mean_pixel
+
+    dst = out[y1:y2, x1:x2]
+    if (new_h, new_w) == (h, w):
+        dst[...] = image
+    else:
+        # Resize rows into a [new_h, w, channels] float32 buffer
+        indices, weights = compute_resize_plan(h, new_h)
+        rows = np.zeros((new_h, w) + image.shape[2:], dtype=out.dtype)
+        tap = np.empty_like(rows)
+        for t in range(indices.shape[1]):
+            tap[...] = image[indices[:, t]]
+            tap *= weights[:, t, None, None]
+            rows += tap
+        # Then columns, accumulating into the output window directly
+        indices, weights = compute_resize_plan(w, new_w)
+        dst[...] = 0
+        tap = np.empty_like(dst)
+        for t in range(indices.shape[1]):
+            np.take(rows, indices[:, t], axis=1, out=tap)
+            tap *= weights[None, :, t, None]
+            dst += tap
+        if np.issubdtype(image.dtype, np.integer):
+            # resize_image() casts the resized image back to its type
+            np.trunc(dst, out=dst)
+    dst -= mean_pixel
+    return out
+
+
+@functools.lru_cache(maxsize=1024)
+def compute_nearest_indices(in_size, out_size):
+    """Returns, for each of the out_size output pixels, the index of the
+    input pixel that nearest-neighbour resizing copies into it. The first
+    and last pixels are aligned, as in scipy.ndimage.zoom(order=0).
+
+    Returns: [out_size] read-only int array.
+    """
+    if in_size == 1 or out_size == 1:
+        indices = np.zeros(out_size, dtype=np.intp)
+    else:
+        step = (in_size - 1) / (out_size - 1)
+        indices = np.floor(np.arange(out_size) * step + 0.5).astype(np.intp)
+    indices.flags.writeable = False
+    return indices
+
+
 def resize_mask(mask, scale, padding, crop=None):
     """Resizes a mask using the given scale and padding.
     Typically, you get the scale and padding from resize_image() to
     ensure both, the image and the mask, are resized consistently.
 
+    Nearest-neighbour resizing is a gather of rows and columns, so all
+    instances are resized together with the cached index vectors of
+    compute_nearest_indices() and written straight into the padded output.
+    Works for any dtype, so label maps of shape [height, width] are
+    resized the same way.
+
     scale: mask scaling factor
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
-    # Suppress warning from scipy 0.13.0, the output shape of zoom() is
-    # calculated with round() instead of int()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    h, w = mask.shape[:2]
+    rows = compute_nearest_indices(h, int(round(h * scale)))
+    cols = compute_nearest_indices(w, int(round(w * scale)))
+    if crop is not None:
+        y, x, crop_h, crop_w = crop
+        rows = rows[y:y + crop_h]
+        cols = cols[x:x + crop_w]
+        return np.take(np.take(mask, rows, axis=0), cols, axis=1)
+    (top, bottom), (left, right) = padding[:2]
+    out = np.zeros((top + len(rows) + bottom, left + len(cols) + right) +
+                   mask.shape[2:], dtype=mask.dtype)
+    out[top:top + len(rows), left:left + len(cols)] = \
+        np.take(np.take(mask, rows, axis=0), cols, axis=1)
+    return out
+
+
+def resize_polygons(polygons, scale, padding, crop=None):
+    """Applies the resizing and padding (or cropping) of resize_image() to
+    polygon vertices. The polygon counterpart of resize_mask().
+
+    polygons: List of [vertex_count, (y, x)] arrays in pixel coordinates,
+        where pixel (i, j) is centered on (i, j).
+    scale, padding, crop: As returned by resize_image().
+
+    Returns a list of [vertex_count, (y, x)] float arrays.
+    """
     if crop is not None:
-        y, x, h, w = crop
-        mask = mask[y:y + h, x:x + w]
+        offset = -np.array(crop[:2], dtype=np.float64)
     else:
-        mask = np.pad(mask, padding, mode='constant', constant_values=0)
-    return mask
+        offset = np.array([padding[0][0], padding[1][0]], dtype=np.float64)
+    # Pixel centers move from i to (i + 0.5) * scale - 0.5
+    return [(np.asarray(p, dtype=np.float64) + 0.5) * scale - 0.5 + offset
+            for p in polygons]
 
 
 def minimize_mask(bbox, mask, mini_shape):
     """Resize masks to a smaller version to reduce memory load.
     Mini-masks can be resized back to image scale using expand_masks()
 
+    Each box is resized with the cached bilinear resize matrices of
+    compute_resize_matrix(), which instances of the same size share, and
+    written straight into the output stack.
+
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
+    mini_mask = np.zeros(tuple(mini_shape) + (mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
         y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
+        if y2 <= y1 or x2 <= x1:
             raise Exception("Invalid bounding box with area of zero")
+        # Pick slice and cast to bool in case load_mask() returned wrong dtype
+        m = mask[y1:y2, x1:x2, i].astype(bool)
         # Resize with bilinear interpolation
-        m = skimage.transform.resize(m, mini_shape, order=1, mode="constant")
-        mini_mask[:, :, i] = np.around(m).astype(np.bool)
+        mini_mask[:, :, i] = resize_mask_to_box(m, mini_shape[0], mini_shape[1]) > 0.5
     return mini_mask
 
 
+def clip_polygon(polygon, y1, x1, y2, x2):
+    """Clips a polygon to a rectangle with the Sutherland-Hodgman algorithm.
+
+    polygon: [vertex_count, (y, x)] array.
+    y1, x1, y2, x2: Bounds of the rectangle.
+
+    Returns a [vertex_count, (y, x)] array. Empty if the polygon is outside.
+    """
+    for axis, bound, sign in [(0, y1, 1), (0, y2, -1), (1, x1, 1), (1, x2, -1)]:
+        if len(polygon) == 0:
+            break
+        # Signed distance of the vertices to the edge. Inside if >= 0
+        d = (polygon[:, axis] - bound) * sign
+        if np.all(d >= 0):
+            continue
+        prev = np.roll(polygon, 1, axis=0)
+        d_prev = np.roll(d, 1)
+        # Points where the polygon edges cross the rectangle edge
+        crossing = (d >= 0) != (d_prev >= 0)
+        t = d_prev[crossing] / (d_prev[crossing] - d[crossing])
+        points = prev[crossing] + t[:, None] * (polygon[crossing] - prev[crossing])
+        # Each vertex is preceded by its crossing point, if any
+        out = []
+        for i, j in zip(np.where(crossing)[0], range(len(points))):
+            out.append((i, 0, points[j]))
+        for i in np.where(d >= 0)[0]:
+            out.append((i, 1, polygon[i]))
+        out.sort(key=lambda o: o[:2])
+        polygon = np.array([o[2] for o in out]).reshape([-1, 2])
+    return polygon
+
+
+def clip_polygons(polygons, window):
+    """Clips polygons to the pixels of a window.
+
+    polygons: List of [vertex_count, (y, x)] arrays in pixel coordinates.
+    window: (y1, x1, y2, x2) pixels to clip to. y2 and x2 are exclusive.
+
+    Returns a list of [vertex_count, (y, x)] arrays. Polygons outside of the
+    window are empty.
+    """
+    # Edges of the pixels of the window
+    y1, x1, y2, x2 = np.array(window, dtype=np.float64) - 0.5
+    return [clip_polygon(np.asarray(p, dtype=np.float64), y1, x1, y2, x2)
+            for p in polygons]
+
+
+def minimize_polygons(polygons, image_shape, mini_shape, window=None):
+    """Rasterizes polygons straight into mini masks. Gives about what
+    extract_bboxes() and minimize_mask() give for the full size masks
+    of the polygons, without creating the full size masks. Boxes are the
+    pixels inside the bounds of the vertices, so they can be a little larger
+    around thin spikes, which cover no pixel centers in a full size mask.
+
+    polygons: List of [vertex_count, (y, x)] arrays in image pixel
+        coordinates. See resize_polygons().
+    image_shape: [height, width] of the image.
+    mini_shape: [height, width] of the mini masks.
+    window: Optional (y1, x1, y2, x2) area of the image outside of the
+        padding, as returned by resize_image(). Polygons are clipped to it.
+        Defaults to the whole image.
+
+    Returns:
+    bbox: [N, (y1, x1, y2, x2)] boxes of the polygons that cover any pixel
+        of the window.
+    mini_mask: [mini_height, mini_width, N] bool mini masks.
+    keep: [N] indices of the polygons in the input list.
+    """
+    if window is None:
+        window = (0, 0) + tuple(image_shape[:2])
+    boxes = []
+    clipped = []
+    keep = []
+    for i, p in enumerate(clip_polygons(polygons, window)):
+        if len(p) == 0:
+            continue
+        # Pixels with their center inside the vertex bounds
+        y1, x1 = np.ceil(p.min(axis=0))
+        y2, x2 = np.floor(p.max(axis=0)) + 1
+        if y2 > y1 and x2 > x1:
+            boxes.append([y1, x1, y2, x2])
+            clipped.append(p)
+            keep.append(i)
+    bbox = np.array(boxes, dtype=np.int32).reshape([-1, 4])
+    mini_mask = np.zeros(tuple(mini_shape) + (len(keep),), dtype=bool)
+    for i, (p, (y1, x1, y2, x2)) in enumerate(zip(clipped, bbox)):
+        # Map the box to the mini mask grid the way minimize_mask() resizes
+        # it: pixel centers of the box span the full mini mask.
+        ys = (p[:, 0] - y1 + 0.5) * mini_shape[0] / (y2 - y1) - 0.5
+        xs = (p[:, 1] - x1 + 0.5) * mini_shape[1] / (x2 - x1) - 0.5
+        rr, cc = skimage.draw.polygon(ys, xs, shape=mini_shape)
+        mini_mask[rr, cc, i] = True
+    return bbox, mini_mask, np.array(keep, dtype=np.int64)
+
+
 def expand_mask(bbox, mini_mask, image_shape):
     """Resizes mini masks back to image size. Reverses the change
     of minimize_mask().
 
+    Like minimize_mask(), uses the cached bilinear resize matrices and
+    writes each instance straight into its box in the output stack.
+
     See inspect_data.ipynb notebook for more details.
     """
-    mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
+    mask = np.zeros(tuple(image_shape[:2]) + (mini_mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
+        if y2 <= y1 or x2 <= x1:
+            continue
         # Resize with bilinear interpolation
-        m = skimage.transform.resize(m, (h, w), order=1, mode="constant")
-        mask[y1:y2, x1:x2, i] = np.around(m).astype(np.bool)
+        m = resize_mask_to_box(mini_mask[:, :, i], y2 - y1, x2 - x1)
+        mask[y1:y2, x1:x2, i] = m > 0.5
     return mask
 
 
@@ -585,6 +1266,414 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+@functools.lru_cache(maxsize=1024)
+def compute_resize_plan(in_size, out_size):
+    """Computes the sampling plan to resize one axis from in_size to
+    out_size pixels with bilinear interpolation.
+
+    Pixel centers are aligned (half-pixel offsets) and samples that fall
+    outside the input are clamped to the edge. When downscaling, the
+    triangle filter is widened to cover all the input pixels that map to
+    an output pixel, which anti-aliases the result.
+
+    Used by mold_image_into(). The masks are resized with the matrices of
+    compute_resize_matrix() instead, which follow skimage.
+
+    Plans only depend on the sizes, so they're cached.
+
+    Returns:
+    indices: [out_size, taps] int32 indices of the input pixels to sample.
+    weights: [out_size, taps] float32 weights of each sample. Rows sum to 1.
+    """
+    ratio = in_size / out_size
+    support = max(1.0, ratio)
+    centers = (np.arange(out_size) + 0.5) * ratio
+    taps = int(math.ceil(2 * support)) + 1
+    first = np.floor(centers - support).astype(np.int32)
+    indices = first[:, None] + np.arange(taps, dtype=np.int32)[None, :]
+    weights = 1 - np.abs((indices + 0.5 - centers[:, None]) / support)
+    weights = np.maximum(weights, 0)
+    weights /= np.sum(weights, axis=1, keepdims=True)
+    indices = np.clip(indices, 0, in_size - 1)
+    return indices, weights.astype(np.float32)
+
+
+@functools.lru_cache(maxsize=1024)
+def compute_resize_matrix(in_size, out_size, anti_aliasing=False):
+    """Computes the matrix that resizes one axis from in_size to out_size
+    pixels as skimage.transform.resize(order=1, mode="constant") does.
+
+    Pixel centers are aligned (half-pixel offsets) and samples that fall
+    outside the input are blended with zeros. With anti_aliasing, axes
+    that are downscaled are first smoothed with skimage's Gaussian filter
+    (sigma = (in_size / out_size - 1) / 2, zero padded), which is folded
+    into the same matrix.
+
+    Returns: [out_size, in_size] float32 matrix M such that M @ x resizes
+        the first axis of x from in_size to out_size.
+    """
+    ratio = in_size / out_size
+    # Bilinear interpolation, with zero weights for samples outside the input
+    centers = (np.arange(out_size) + 0.5) * ratio - 0.5
+    first = np.floor(centers).astype(np.int64)
+    fraction = centers - first
+    matrix = np.zeros((out_size, in_size + 2))
+    rows = np.arange(out_size)
+    # Column 0 and in_size + 1 stand for the zero padding on each side
+    matrix[rows, np.clip(first + 1, 0, in_size + 1)] += 1 - fraction
+    matrix[rows, np.clip(first + 2, 0, in_size + 1)] += fraction
+    matrix = matrix[:, 1:-1]
+    if anti_aliasing and ratio > 1:
+        # Gaussian kernel of scipy.ndimage.gaussian_filter()
+        sigma = (ratio - 1) / 2
+        radius = int(4.0 * sigma + 0.5)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+        gaussian = np.zeros((in_size, in_size))
+        for offset, weight in zip(range(-radius, radius + 1), kernel):
+            gaussian += np.eye(in_size, k=offset) * weight
+        matrix = np.dot(matrix, gaussian)
+    return matrix.astype(np.float32)
+
+
+def unmold_masks(masks, boxes, image_shape, out=None, threshold=0.5):
+    """Batched version of unmold_mask(). Converts the masks generated by
+    the neural network to full size binary masks.
+
+    The small masks are resized to their boxes with separable bilinear
+    interpolation (two small float32 matrix products per mask) and are
+    written straight into one output array, so no full size temporary
+    is created per instance.
+
+    masks: [N, height, width] of type float. Typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [H, W, ...] shape of the original image.
+    out: Optional. A bool array [H, W, >= N] to write the masks into.
+        Pass the same array on every call to reuse it. The first N
+        channels are overwritten.
+    threshold: Masks pixels with values >= threshold are set.
+
+    Returns a bool array [H, W, N]. A view of out if it was provided.
+    """
+    N = masks.shape[0]
+    if out is None:
+        out = np.zeros(tuple(image_shape[:2]) + (N,), dtype=bool)
+    else:
+        assert out.shape[:2] == tuple(image_shape[:2]) and out.shape[2] >= N
+        out = out[:, :, :N]
+        out[...] = False
+    # Boxes differ in size, so each mask is resized on its own. Resizing
+    # them in one pass would need a [N, max height, max width] buffer, which
+    # is larger than the output itself, and the products are a small part
+    # of the time next to writing the output.
+    for i in range(N):
+        y1, x1, y2, x2 = boxes[i]
+        if y2 <= y1 or x2 <= x1:
+            continue
+        mask = resize_mask_to_box(masks[i], y2 - y1, x2 - x1)
+        out[y1:y2, x1:x2, i] = mask >= threshold
+    return out
+
+
+def resize_mask_to_box(mask, height, width):
+    """Resizes a small mask to [height, width] with the cached bilinear
+    resize matrices. Returns a float32 array.
+
+    Same as skimage.transform.resize(order=1, mode="constant"), up to
+    float32 rounding. Like skimage, float masks are anti-aliased when
+    downscaled and bool masks aren't, and the result is clipped to the
+    range of values of the mask.
+    """
+    if mask.dtype == bool:
+        row_matrix = compute_resize_matrix(mask.shape[0], height)
+        col_matrix = compute_resize_matrix(mask.shape[1], width)
+        return np.dot(np.dot(row_matrix, mask.astype(np.float32)), col_matrix.T)
+    row_matrix = compute_resize_matrix(mask.shape[0], height, True)
+    col_matrix = compute_resize_matrix(mask.shape[1], width, True)
+    resized = np.dot(np.dot(row_matrix, mask.astype(np.float32)), col_matrix.T)
+    return np.clip(resized, mask.min(), mask.max(), out=resized)
+
+
+def unmold_cropped_masks(masks, boxes, image_shape, threshold=0.5):
+    """Same as unmold_masks() but returns a CroppedMasks object that only
+    stores the part of each mask inside its box.
+
+    masks: [N, height, width] of type float. Typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [H, W, ...] shape of the original image.
+    """
+    crops = []
+    for i in range(masks.shape[0]):
+        y1, x1, y2, x2 = boxes[i]
+        h = max(y2 - y1, 0)
+        w = max(x2 - x1, 0)
+        if h and w:
+            crops.append(resize_mask_to_box(masks[i], h, w) >= threshold)
+        else:
+            crops.append(np.zeros((h, w), dtype=bool))
+    return CroppedMasks(boxes, crops, image_shape)
+
+
+############################################################
+#  Cropped Masks
+############################################################
+
+class CroppedMasks(object):
+    """A compact alternative to dense [H, W, N] instance masks.
+
+    Each instance is stored as a bool mask cropped to its bounding box.
+    Pixels outside the box are implicitly False, so memory grows with the
+    area of the boxes rather than with the image size times the instance
+    count. Use dense() or instance() to get full size masks when needed.
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels. (y2, x2) is outside the box.
+    crops: List of N bool arrays. Crop i has shape [y2 - y1, x2 - x1].
+    image_shape: [H, W, ...] shape of the image the masks belong to.
+    """
+
+    def __init__(self, boxes, crops, image_shape):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        self.crops = list(crops)
+        self.image_shape = tuple(int(d) for d in image_shape[:2])
+        assert len(self.crops) == self.boxes.shape[0]
+
+    @classmethod
+    def from_dense(cls, masks):
+        """Builds a CroppedMasks object from a dense [H, W, N] mask array."""
+        boxes = extract_bboxes(masks)
+        crops = [masks[y1:y2, x1:x2, i].astype(bool)
+                 for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(boxes, crops, masks.shape)
+
+    @property
+    def shape(self):
+        """Shape of the equivalent dense array: [H, W, N]."""
+        return self.image_shape + (len(self.crops),)
+
+    def __len__(self):
+        return len(self.crops)
+
+    def instance(self, i):
+        """Returns the full size [H, W] bool mask of instance i."""
+        mask = np.zeros(self.image_shape, dtype=bool)
+        y1, x1, y2, x2 = self.boxes[i]
+        mask[y1:y2, x1:x2] = self.crops[i]
+        return mask
+
+    def dense(self):
+        """Returns all the masks as a dense [H, W, N] bool array."""
+        masks = np.zeros(self.shape, dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            masks[y1:y2, x1:x2, i] = self.crops[i]
+        return masks
+
+    def union(self):
+        """Returns a [H, W] bool mask of the pixels covered by any instance."""
+        mask = np.zeros(self.image_shape, dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            mask[y1:y2, x1:x2] |= self.crops[i]
+        return mask
+
+    def area(self):
+        """Returns the number of pixels of each instance. [N] int array."""
+        return np.array([np.count_nonzero(c) for c in self.crops],
+                        dtype=np.int64)
+
+    def select(self, indices):
+        """Returns a new CroppedMasks object with the given instances.
+        indices: A slice, or an array of instance indices or of bools.
+        """
+        ids = np.arange(len(self.crops))[indices]
+        return CroppedMasks(self.boxes[ids], [self.crops[i] for i in ids],
+                            self.image_shape)
+
+    def to_rle(self):
+        """Returns the masks as a list of COCO RLE dicts. See encode_rle()."""
+        return [encode_cropped_rle(crop, box, self.image_shape)
+                for crop, box in zip(self.crops, self.boxes)]
+
+
+def select_masks(masks, indices):
+    """Picks instances from a set of masks. Works the same for dense
+    [H, W, N] arrays, CroppedMasks objects and lists of RLE dicts.
+    indices: A slice, or an array of instance indices or of bools.
+    """
+    if isinstance(masks, CroppedMasks):
+        return masks.select(indices)
+    if isinstance(masks, list):
+        return [masks[i] for i in np.arange(len(masks))[indices]]
+    return masks[..., indices]
+
+
+############################################################
+#  Run-Length Encoding
+############################################################
+
+# Masks are encoded in the uncompressed COCO RLE format:
+#   {"size": [height, width], "counts": [n0, n1, n2, ...]}
+# The mask is flattened in column-major (Fortran) order and counts holds
+# the lengths of alternating runs of 0s and 1s, starting with 0s. This is
+# what pycocotools.mask.frPyObjects() accepts, and it's JSON serializable.
+
+def rle_from_intervals(starts, ends, size):
+    """Builds a RLE dict from the runs of 1s of a flattened mask.
+    starts, ends: Sorted 1D arrays. Run i covers [starts[i], ends[i]) in
+        the column-major flattened mask. Adjacent runs are merged.
+    size: (height, width) of the mask.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if starts.shape[0]:
+        # Merge runs that touch each other
+        keep = np.concatenate([[True], starts[1:] != ends[:-1]])
+        starts = starts[keep]
+        ends = ends[np.concatenate([keep[1:], [True]])]
+    # Alternate lengths of 0s and 1s
+    bounds = np.stack([starts, ends], axis=1).ravel()
+    bounds = np.concatenate([[0], bounds, [int(size[0]) * int(size[1])]])
+    counts = np.diff(bounds)
+    return {"size": [int(size[0]), int(size[1])], "counts": counts.tolist()}
+
+
+def rle_to_intervals(rle):
+    """Returns the runs of 1s of a RLE dict as two arrays (starts, ends).
+    See rle_from_intervals().
+    """
+    bounds = np.cumsum(np.asarray(rle["counts"], dtype=np.int64))
+    starts = bounds[0::2]
+    ends = bounds[1::2]
+    return starts[:ends.shape[0]], ends
+
+
+def encode_rle(mask):
+    """Encodes a [height, width] binary mask as a COCO RLE dict."""
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [flat.shape[0]]])
+    # Runs alternate. Keep the ones that are 1s.
+    first = 0 if flat.shape[0] and flat[0] else 1
+    return rle_from_intervals(bounds[first:-1:2], bounds[first + 1::2],
+                              mask.shape[:2])
+
+
+def encode_cropped_rle(crop, box, image_shape):
+    """Encodes a mask cropped to its box as a COCO RLE dict of the full
+    image without creating the full size mask.
+
+    crop: [y2 - y1, x2 - x1] binary mask.
+    box: (y1, x1, y2, x2) position of the crop in the image.
+    image_shape: [H, W, ...] shape of the image.
+    """
+    height = int(image_shape[0])
+    y1, x1 = int(box[0]), int(box[1])
+    # Pad each column with 0s so runs never cross columns of the crop
+    padded = np.zeros((crop.shape[0] + 2, crop.shape[1]), dtype=np.int8)
+    padded[1:-1] = crop
+    changes = np.diff(padded.ravel(order="F"))
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    # Convert indices in the padded crop to indices in the full image
+    col_starts, row_starts = np.divmod(starts, padded.shape[0])
+    col_ends, row_ends = np.divmod(ends, padded.shape[0])
+    starts = (x1 + col_starts) * height + y1 + row_starts
+    ends = (x1 + col_ends) * height + y1 + row_ends
+    return rle_from_intervals(starts, ends, image_shape[:2])
+
+
+def decode_rle(rle):
+    """Decodes a COCO RLE dict to a [height, width] bool mask."""
+    height, width = rle["size"]
+    flat = np.zeros(height * width, dtype=bool)
+    for start, end in zip(*rle_to_intervals(rle)):
+        flat[start:end] = True
+    return flat.reshape((width, height)).T
+
+
+def rle_area(rle):
+    """Returns the number of pixels set in a RLE encoded mask."""
+    return int(np.sum(rle["counts"][1::2]))
+
+
+def compute_overlaps_rle(rles1, rles2):
+    """Computes IoU overlaps between two lists of RLE encoded masks
+    without decoding them.
+
+    The intersection of two masks is computed from their runs of 1s. For
+    each run of the second mask, the number of pixels of the first mask
+    before its start and end is looked up with a binary search over the
+    cumulative run lengths of the first mask.
+
+    Returns: [len(rles1), len(rles2)] IoU overlaps.
+    """
+    overlaps = np.zeros((len(rles1), len(rles2)))
+    runs1 = [rle_to_intervals(r) for r in rles1]
+    runs2 = [rle_to_intervals(r) for r in rles2]
+    area1 = [np.sum(e - s) for s, e in runs1]
+    area2 = [np.sum(e - s) for s, e in runs2]
+    for i, (s1, e1) in enumerate(runs1):
+        if not s1.shape[0]:
+            continue
+        # Number of 1s in the first mask before the end of each of its runs
+        cumulative = np.concatenate([[0], np.cumsum(e1 - s1)])
+
+        def ones_before(positions):
+            k = np.searchsorted(e1, positions, side="right")
+            partial = positions - s1[np.minimum(k, s1.shape[0] - 1)]
+            partial = np.where(k < s1.shape[0], np.maximum(partial, 0), 0)
+            return cumulative[k] + partial
+
+        for j, (s2, e2) in enumerate(runs2):
+            # Skip masks with disjoint extents
+            if not s2.shape[0] or s2[0] >= e1[-1] or s1[0] >= e2[-1]:
+                continue
+            intersection = np.sum(ones_before(e2) - ones_before(s2))
+            if intersection:
+                overlaps[i, j] = intersection / \
+                    (area1[i] + area2[j] - intersection)
+    return overlaps
+
+
+def as_rle_masks(masks):
+    """Converts a set of masks to a list of RLE dicts.
+    masks: [H, W, N] array, CroppedMasks object or list of RLE dicts.
+    """
+    if isinstance(masks, list):
+        return masks
+    if isinstance(masks, CroppedMasks):
+        return masks.to_rle()
+    return [encode_rle(masks[..., i]) for i in range(masks.shape[-1])]
+
+
+def compute_overlaps_cropped_masks(masks1, masks2):
+    """Computes IoU overlaps between two sets of CroppedMasks. Only the
+    pairs with intersecting boxes are compared, and only inside the
+    intersection of their boxes.
+
+    Returns: [len(masks1), len(masks2)] IoU overlaps.
+    """
+    overlaps = np.zeros((len(masks1), len(masks2)))
+    if not len(masks1) or not len(masks2):
+        return overlaps
+    area1 = masks1.area()
+    area2 = masks2.area()
+    b1 = masks1.boxes
+    b2 = masks2.boxes
+    # Intersection of every pair of boxes
+    y1 = np.maximum(b1[:, None, 0], b2[None, :, 0])
+    x1 = np.maximum(b1[:, None, 1], b2[None, :, 1])
+    y2 = np.minimum(b1[:, None, 2], b2[None, :, 2])
+    x2 = np.minimum(b1[:, None, 3], b2[None, :, 3])
+    for i, j in zip(*np.where((y2 > y1) & (x2 > x1))):
+        c1 = masks1.crops[i][y1[i, j] - b1[i, 0]:y2[i, j] - b1[i, 0],
+                             x1[i, j] - b1[i, 1]:x2[i, j] - b1[i, 1]]
+        c2 = masks2.crops[j][y1[i, j] - b2[j, 0]:y2[i, j] - b2[j, 0],
+                             x1[i, j] - b2[j, 1]:x2[i, j] - b2[j, 1]]
+        intersection = np.count_nonzero(c1 & c2)
+        if intersection:
+            overlaps[i, j] = intersection / (area1[i] + area2[j] - intersection)
+    return overlaps
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -648,6 +1737,113 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorGridIndex(object):
+    """Spatial index of the anchors of a feature pyramid.
+
+    The anchors of each level lie on a regular grid, so the anchors that
+    can overlap a box are found by computing the range of grid cells the
+    box covers, instead of comparing the box with every anchor. Build it
+    once per image shape and reuse it for all the images of that shape.
+
+    The arguments are the same as generate_pyramid_anchors().
+    """
+
+    def __init__(self, scales, ratios, feature_shapes, feature_strides,
+                 anchor_stride):
+        self.anchors = generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                                feature_strides, anchor_stride)
+        self.num_ratios = len(ratios)
+        ratios = np.array(ratios, dtype=np.float64)
+        # Grid geometry of each level, in the order of the anchors
+        self.levels = []
+        offset = 0
+        for scale, shape, stride in zip(scales, feature_shapes,
+                                        feature_strides):
+            rows = len(range(0, shape[0], anchor_stride))
+            cols = len(range(0, shape[1], anchor_stride))
+            self.levels.append({
+                "offset": offset,
+                "rows": rows,
+                "cols": cols,
+                "step": stride * anchor_stride,
+                # Largest half height and width of the anchors of the level
+                "half_h": np.max(scale / np.sqrt(ratios)) / 2,
+                "half_w": np.max(scale * np.sqrt(ratios)) / 2,
+                # All the ratios have the same area
+                "area": scale ** 2,
+            })
+            offset += rows * cols * self.num_ratios
+        assert offset == self.anchors.shape[0]
+
+    def candidates(self, boxes, min_iou=0.):
+        """Returns the sorted indices of the anchors that might overlap the
+        given boxes with an IoU > 0, or an IoU >= min_iou if min_iou is
+        given. Anchors whose area is too different from the area of a box
+        can't reach min_iou, so their levels are skipped.
+
+        boxes: [N, (y1, x1, y2, x2)] in pixels.
+        """
+        indices = []
+        for y1, x1, y2, x2 in boxes:
+            area = (y2 - y1) * (x2 - x1)
+            for level in self.levels:
+                # IoU <= min(area1, area2) / max(area1, area2)
+                if min_iou > 0 and (area <= 0 or min(area, level["area"]) <
+                                    (min_iou - 1e-6) * max(area, level["area"])):
+                    continue
+                step = level["step"]
+                # Grid cells whose anchors might intersect the box
+                r0 = max(0, int(np.floor((y1 - level["half_h"]) / step)))
+                r1 = min(level["rows"] - 1,
+                         int(np.ceil((y2 + level["half_h"]) / step)))
+                c0 = max(0, int(np.floor((x1 - level["half_w"]) / step)))
+                c1 = min(level["cols"] - 1,
+                         int(np.ceil((x2 + level["half_w"]) / step)))
+                if r0 > r1 or c0 > c1:
+                    continue
+                r = np.arange(r0, r1 + 1)[:, None, None]
+                c = np.arange(c0, c1 + 1)[None, :, None]
+                a = np.arange(self.num_ratios)[None, None, :]
+                ix = level["offset"] + (r * level["cols"] + c) * self.num_ratios + a
+                indices.append(ix.ravel())
+        if not indices:
+            return np.zeros([0], dtype=np.int64)
+        return np.unique(np.concatenate(indices))
+
+    def compute_overlaps_max(self, boxes, min_iou=0.):
+        """Same as compute_overlaps_max(self.anchors, boxes), but only
+        computes the IoU of the candidate anchors of the boxes.
+
+        boxes: [N, (y1, x1, y2, x2)] in pixels.
+        min_iou: IoU values below min_iou might be reported as 0. The best
+            anchor of each box (argmax2) is still exact.
+
+        Returns max1, argmax1, max2, argmax2. See compute_overlaps_max().
+        """
+        n1, n2 = self.anchors.shape[0], boxes.shape[0]
+        max1 = np.zeros([n1], dtype=np.float32)
+        argmax1 = np.zeros([n1], dtype=np.int64)
+        max2 = np.zeros([n2], dtype=np.float32)
+        argmax2 = np.zeros([n2], dtype=np.int64)
+        if n2 == 0:
+            return max1, argmax1, max2, argmax2
+        ix = self.candidates(boxes, min_iou)
+        if ix.shape[0]:
+            max1[ix], argmax1[ix], max2, argmax2 = compute_overlaps_max(
+                self.anchors[ix], boxes)
+            argmax2 = ix[argmax2]
+        # Boxes without a good enough candidate (rare). Their best anchor
+        # might be elsewhere, so search all the anchors. Then make sure the
+        # matches of that anchor are exact too.
+        for j in np.where((max2 <= 0) | (max2 < min_iou))[0]:
+            _, _, m, a = compute_overlaps_max(self.anchors, boxes[j:j + 1])
+            max2[j], argmax2[j] = m[0], a[0]
+            a = a[0]
+            m, ix, _, _ = compute_overlaps_max(self.anchors[a:a + 1], boxes)
+            max1[a], argmax1[a] = m[0], ix[0]
+        return max1, argmax1, max2, argmax2
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -667,6 +1863,9 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     iou_threshold=0.5, score_threshold=0.0):
     """Finds matches between prediction and ground truth instances.
 
+    gt_masks, pred_masks: [height, width, instances] arrays, CroppedMasks
+        objects or lists of RLE dicts.
+
     Returns:
         gt_match: 1-D array. For each GT box it has the index of the matched
                   predicted box.
@@ -677,7 +1876,7 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
-    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    gt_masks = select_masks(gt_masks, slice(gt_boxes.shape[0]))
     pred_boxes = trim_zeros(pred_boxes)
     pred_scores = pred_scores[:pred_boxes.shape[0]]
     # Sort predictions by score from high to low
@@ -685,7 +1884,7 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
     pred_boxes = pred_boxes[indices]
     pred_class_ids = pred_class_ids[indices]
     pred_scores = pred_scores[indices]
-    pred_masks = pred_masks[..., indices]
+    pred_masks = select_masks(pred_masks, indices)
 
     # Compute IoU overlaps [pred_masks, gt_masks]
     overlaps = compute_overlaps_masks(pred_masks, gt_masks)
@@ -87,7 +87,7 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                       colors=None, captions=None):
     """
     boxes: [num_instance, (y1, x1, y2, x2, class_id)] in image coordinates.
-    masks: [height, width, num_instances]
+    masks: [height, width, num_instances] or a utils.CroppedMasks object
     class_ids: [num_instances]
     class_names: list of class names of the dataset
     scores: (optional) confidence scores for each box
@@ -148,7 +148,10 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                 color='w', size=11, backgroundcolor="none")
 
         # Mask
-        mask = masks[:, :, i]
+        if isinstance(masks, utils.CroppedMasks):
+            mask = masks.instance(i)
+        else:
+            mask = masks[:, :, i]
         if show_mask:
             masked_image = apply_mask(masked_image, mask, color)
 